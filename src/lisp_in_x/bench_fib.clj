@@ -0,0 +1,10 @@
+;; Benchmark: plain recursion, see bench_engines
+
+(def fib
+  (fn [n]
+    (if (<= n 1)
+      n
+      (+ (fib (dec n))
+         (fib (- n 2))))))
+
+(println "fib 32 = " (fib 32))
@@ -0,0 +1,6 @@
+;; Benchmark: a numeric loop/recur, see bench_engines
+
+(println "sum 0..9999999 = " (loop [i 0 acc 0]
+                               (if (< i 10000000)
+                                 (recur (inc i) (+ acc i))
+                                 acc)))
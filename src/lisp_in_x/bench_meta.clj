@@ -0,0 +1,17 @@
+;; Benchmark: mutual recursion and a higher-order loop, run by lisp_in_lisp
+;; on top of the interpreter, see bench_engines
+
+(load-file "src/lisp_in_x/lisp_in_lisp.clj")
+(reset-globals)
+
+(println "meta sum of evens 0..400 = "
+  (eval nil '(do (def even?
+                   (fn [n] (if (= n 0) true (odd? (dec n)))))
+                 (def odd?
+                   (fn [n] (if (= n 0) false (even? (dec n)))))
+                 (def fold
+                   (fn [f acc n]
+                     (if (= n 0)
+                       acc
+                       (fold f (f acc n) (dec n)))))
+                 (fold (fn [acc n] (if (even? n) (+ acc n) acc)) 0 400))))
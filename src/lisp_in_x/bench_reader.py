@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+
+import rpython.rlib.streamio as streamio
+
+import in_rpython_jit as interp
+
+# Reader benchmark. Runs untranslated on top of the rpython package:
+# python src/lisp_in_x/bench_reader.py [--mmap] [--generate bytes] [file.clj ...]
+#
+# or translated, which gives the numbers that matter:
+# ../pypy/rpython/bin/rpython src/lisp_in_x/bench_reader.py
+# ./bench_reader-c --generate 10485760
+#
+# --generate writes tests.clj repeated up to the given size into a scratch file
+# and benchmarks that as well.
+
+default_files = ["src/lisp_in_x/tests.clj",
+                 "src/lisp_in_x/stdlib.clj",
+                 "src/lisp_in_x/lisp_in_lisp.clj"]
+
+generated_file = "bench_reader_input.clj"
+
+
+def read_file(file_name, use_mmap):
+    if use_mmap:
+        return interp.read_all_and_close(interp.MappedFileReader(file_name))
+    return interp.read_all_and_close(interp.open_reader(file_name))
+
+
+def generate(file_name, size):
+    rdr = streamio.open_file_as_stream(default_files[0])
+    chunk = rdr.readall()
+    rdr.close()
+
+    out = streamio.open_file_as_stream(file_name, "w")
+    written = 0
+    while written < size:
+        out.write(chunk)
+        written += len(chunk)
+    out.close()
+
+
+def bench(file_name, use_mmap):
+    # Small inputs get repeated so the timer has something to measure
+    size = os.stat(file_name).st_size
+    repeat = 1 + 1024 * 1024 / (size + 1)
+    if repeat > 100:
+        repeat = 100
+
+    best = -1.0
+    for i in range(repeat):
+        start = time.time()
+        read_file(file_name, use_mmap)
+        elapsed = time.time() - start
+        if best < 0 or elapsed < best:
+            best = elapsed
+
+    kb_per_sec = int(size / 1024.0 / best) if best > 0 else 0
+    print("%s: %d bytes, %d us, %d KB/s" % (file_name, size, int(best * 1000000), kb_per_sec))
+
+
+def entry_point(argv):
+    files = []
+    use_mmap = False
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        if arg == "--mmap":
+            use_mmap = True
+        elif arg == "--generate":
+            i += 1
+            generate(generated_file, int(argv[i]))
+            files.append(generated_file)
+        else:
+            files.append(arg)
+        i += 1
+
+    if len(files) == 0:
+        files = default_files
+
+    for file_name in files:
+        bench(file_name, use_mmap)
+    return 0
+
+
+def target(*args):
+    return entry_point, None
+
+
+if __name__ == "__main__":
+    sys.exit(entry_point(sys.argv))
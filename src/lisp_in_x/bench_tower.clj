@@ -0,0 +1,14 @@
+;; Benchmark: the same fib, run by lisp_in_lisp on top of the interpreter,
+;; see bench_engines
+
+(load-file "src/lisp_in_x/lisp_in_lisp.clj")
+(reset-globals)
+
+(println "meta fib 24 = "
+  (eval nil '(do (def fib
+                   (fn [n]
+                     (if (<= n 1)
+                       n
+                       (+ (fib (dec n))
+                          (fib (- n 2))))))
+                 (fib 24))))
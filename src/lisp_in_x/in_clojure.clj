@@ -198,7 +198,7 @@
 (defn reset-globals []
   (reset! globals (map-clojure-syms
                     '#{println + * - / < > <= >= = dec inc car cdr cons cons? symbol? apply
-                       load-file nil? vararg read-file die})))
+                       load-file nil? vararg read-file die hash-map get assoc dissoc})))
 
 (defn eval-file [file]
   ;; Hack but it's simple
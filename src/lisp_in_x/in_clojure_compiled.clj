@@ -139,7 +139,7 @@
   (clj/apply f (cons->list args)))
 
 (def predefed-globals '#{println + * - / < > <= >= = dec inc car cdr cons cons? symbol? apply
-                         load-file nil? vararg read-file die})
+                         load-file nil? vararg read-file die hash-map get assoc dissoc})
 
 (defn reset-globals []
   (doseq [global predefed-globals]
@@ -126,8 +126,8 @@
       (symbol? form) (lookup globals env form k)
       true (k globals form))))
 
-(def builtins '[println + * - / < > <= >= = dec inc car cdr cons cons? symbol?
-                load-file nil? load-file die read-file])
+(def builtins '(println + * - / < > <= >= = dec inc car cdr cons cons? symbol?
+                load-file nil? load-file die read-file))
 
 (def add-builtins
   (fn [globals l]
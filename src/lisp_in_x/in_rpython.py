@@ -1,6 +1,12 @@
 import sys
 sys.path.append("../pypy")
+import os
 import rpython.rlib.streamio as streamio
+import rpython.rlib.rmmap as rmmap
+from rpython.rlib.rarithmetic import ovfcheck
+from rpython.rlib.rbigint import rbigint
+import rpython.rlib.objectmodel as objectmodel
+from rpython.rlib.rstring import StringBuilder
 
 
 class Object(object):
@@ -46,19 +52,262 @@ class Integer(Object):
         return self._int_val
 
 
+small_int_min = -128
+small_int_max = 1024
+small_ints = [Integer(i) for i in range(small_int_min, small_int_max + 1)]
+
+# Integers in this range are preallocated, so counters and small arithmetic
+# don't allocate
+def make_int(int_val):
+    if small_int_min <= int_val <= small_int_max:
+        return small_ints[int_val - small_int_min]
+    return Integer(int_val)
+
+
+# Integers that overflow a machine word become BigIntegers, and results that
+# fit one again go back to Integers, so each value has one representation
+class BigInteger(Object):
+    _immutable_ = True
+    _type = Integer._type
+
+    def __init__(self, big_val):
+        self._big_val = big_val
+
+    def to_string(self):
+        return self._big_val.str()
+
+    def type(self):
+        return self._type
+
+
+def make_big(big_val):
+    try:
+        return make_int(big_val.toint())
+    except OverflowError:
+        return BigInteger(big_val)
+
+
+def to_big(num):
+    if isinstance(num, BigInteger):
+        return num._big_val
+    return rbigint.fromint(num.int_val())
+
+
+def add(a, b):
+    if isinstance(a, Integer) and isinstance(b, Integer):
+        try:
+            return make_int(ovfcheck(a._int_val + b._int_val))
+        except OverflowError:
+            pass
+    return make_big(to_big(a).add(to_big(b)))
+
+
+def sub(a, b):
+    if isinstance(a, Integer) and isinstance(b, Integer):
+        try:
+            return make_int(ovfcheck(a._int_val - b._int_val))
+        except OverflowError:
+            pass
+    return make_big(to_big(a).sub(to_big(b)))
+
+
+def mul(a, b):
+    if isinstance(a, Integer) and isinstance(b, Integer):
+        try:
+            return make_int(ovfcheck(a._int_val * b._int_val))
+        except OverflowError:
+            pass
+    return make_big(to_big(a).mul(to_big(b)))
+
+
+def div(a, b):
+    if isinstance(a, Integer) and isinstance(b, Integer):
+        try:
+            return make_int(ovfcheck(a._int_val / b._int_val))
+        except OverflowError:
+            pass
+    return make_big(to_big(a).floordiv(to_big(b)))
+
+
+# Returns -1, 0 or 1 as a is less than, equal to or greater than b
+def compare(a, b):
+    if isinstance(a, Integer) and isinstance(b, Integer):
+        x = a._int_val
+        y = b._int_val
+    else:
+        x = to_big(a)
+        y = to_big(b)
+        if x.lt(y):
+            return -1
+        return 0 if x.eq(y) else 1
+    if x < y:
+        return -1
+    return 0 if x == y else 1
+
+
+# The variadic builtins walk their argument list once. add_all and mul_all
+# keep the running total a machine int until an argument is a BigInteger or a
+# step overflows, and only the result gets boxed; from there on the rest is
+# folded with add and mul.
+def add_all(acc, args):
+    while args is not nil:
+        num = args.car()
+        if not isinstance(num, Integer):
+            break
+        try:
+            acc = ovfcheck(acc + num._int_val)
+        except OverflowError:
+            break
+        args = args.cdr()
+    total = make_int(acc)
+    while args is not nil:
+        total = add(total, args.car())
+        args = args.cdr()
+    return total
+
+
+def mul_all(acc, args):
+    while args is not nil:
+        num = args.car()
+        if not isinstance(num, Integer):
+            break
+        try:
+            acc = ovfcheck(acc * num._int_val)
+        except OverflowError:
+            break
+        args = args.cdr()
+    total = make_int(acc)
+    while args is not nil:
+        total = mul(total, args.car())
+        args = args.cdr()
+    return total
+
+
+def equal(a, b):
+    if isinstance(a, Integer) and isinstance(b, Integer):
+        return a._int_val == b._int_val
+    elif isinstance(a, BigInteger) and isinstance(b, BigInteger):
+        return a._big_val.eq(b._big_val)
+    elif isinstance(a, String) and isinstance(b, String):
+        return a._length == b._length and a.str_val() == b.str_val()
+    return a is b
+
+
+# True if compare gives a result between lo and hi for every pair of
+# neighbouring arguments, so (< a b c) is lo = hi = -1
+def ordered(args, lo, hi):
+    if args is nil:
+        return true
+    prev = args.car()
+    args = args.cdr()
+    while args is not nil:
+        num = args.car()
+        c = compare(prev, num)
+        if c < lo or c > hi:
+            return false
+        prev = num
+        args = args.cdr()
+    return true
+
+
+# A String is either flat, with its characters in _str_val, or a rope: the
+# concatenation of _left and _right, whose characters are only put together
+# the first time they are needed. Concatenating is then O(1), and a text
+# built up piece by piece is copied once in the end, not once per piece.
 class String(Object):
     _immutable_ = True
     _type = Type("String")
 
-    def __init__(self, str_val):
+    def __init__(self, str_val, left=None, right=None):
         self._str_val = str_val
+        self._left = left
+        self._right = right
+        if left is None:
+            self._length = len(str_val)
+            self._flat = None
+        else:
+            self._length = left._length + right._length
+            self._flat = Flattened()
 
     def to_string(self):
-        return '"%s"' % self._str_val
+        return '"%s"' % self.str_val()
 
     def type(self):
         return self._type
 
+    def str_val(self):
+        if self._left is None:
+            return self._str_val
+        if self._flat.str_val is None:
+            builder = StringBuilder(self._length)
+            self.append_to(builder)
+            self._flat.str_val = builder.build()
+        return self._flat.str_val
+
+    # Walks the rope left to right without recursing, ropes built by
+    # appending in a loop are as deep as they are long
+    def append_to(self, builder):
+        todo = [self]
+        while len(todo) > 0:
+            s = todo.pop()
+            if s._left is None:
+                builder.append(s._str_val)
+            elif s._flat.str_val is not None:
+                builder.append(s._flat.str_val)
+            else:
+                todo.append(s._right)
+                todo.append(s._left)
+
+    def substring(self, start, end):
+        if start < 0 or end < start or end > self._length:
+            print("String index out of bounds: %d, %d" % (start, end))
+            raise IndexError
+        assert start >= 0 and end >= 0
+        return String(self.str_val()[start:end])
+
+
+# Where a rope keeps its characters once they have been put together
+class Flattened(object):
+    def __init__(self):
+        self.str_val = None
+
+
+empty_string = String("")
+
+# Concatenations shorter than this are copied into a flat string
+rope_min = 64
+
+def concat(a, b):
+    if a._length == 0:
+        return b
+    elif b._length == 0:
+        return a
+    elif a._length + b._length < rope_min:
+        return String(a.str_val() + b.str_val())
+    return String(None, a, b)
+
+
+# What str makes of an argument: strings as they are, nil as nothing
+def as_string(obj):
+    if isinstance(obj, String):
+        return obj
+    elif obj is nil:
+        return empty_string
+    return String(obj.to_string())
+
+
+# The global a Symbol names, None while it has none. Each Symbol owns its
+# cell, so reading a global never hashes anything.
+class GlobalCell(object):
+    def __init__(self):
+        self._value = None
+
+    def get(self):
+        return self._value
+
+    def set(self, v):
+        self._value = v
+
 
 class SymbolRegistry(object):
     def __init__(self):
@@ -82,6 +331,7 @@ class Symbol(Object):
 
     def __init__(self, str_val):
         self._str_val = str_val
+        self._cell = GlobalCell()
 
     def to_string(self):
         return self._str_val
@@ -173,6 +423,357 @@ class Cons(Object):
 
         return acc
 
+
+# The first cell of a list the reader made, remembers the line the list
+# started on
+class SourceCons(Cons):
+    _immutable_ = True
+
+    def __init__(self, car, cdr, line):
+        self._car = car
+        self._cdr = cdr
+        self._line = line
+
+    def line(self):
+        return self._line
+
+
+def source_list(lst, line):
+    if len(lst) == 0:
+        return nil
+    acc = nil
+    i = len(lst) - 1
+    while i > 0:
+        acc = Cons(lst[i], acc)
+        i -= 1
+    return SourceCons(lst[0], acc, line)
+
+def list_length(lst):
+    count = 0
+    while lst is not nil:
+        count += 1
+        lst = lst.cdr()
+    return count
+
+
+def fixed_list(acc):
+    result = [None] * len(acc)
+    for i in range(len(acc)):
+        result[i] = acc[i]
+    return result
+
+# An array-backed vector, what the reader makes of [...] outside of fn, let
+# and loop bindings. Vectors are never changed in place, conj copies.
+class Vector(Object):
+    _immutable_ = True
+    _immutable_fields_ = ["_items[*]"]
+    _type = Type("Vector")
+
+    def __init__(self, items):
+        self._items = items
+
+    def to_string(self):
+        return "[" + " ".join([itm.to_string() for itm in self._items]) + "]"
+
+    def type(self):
+        return self._type
+
+    def count(self):
+        return len(self._items)
+
+    def nth(self, index):
+        if index < 0 or index >= len(self._items):
+            print("Index out of bounds: %d" % index)
+            raise IndexError
+        return self._items[index]
+
+    def conj(self, args):
+        items = [itm for itm in self._items]
+        while args is not nil:
+            items.append(args.car())
+            args = args.cdr()
+        return Vector(fixed_list(items))
+
+    @staticmethod
+    def from_cons(lst):
+        items = []
+        while lst is not nil:
+            items.append(lst.car())
+            lst = lst.cdr()
+        return Vector(fixed_list(items))
+
+
+# Persistent hash map
+#
+# A hash array mapped trie: each level of BitmapNodes consumes 5 bits of the
+# key's hash, and a bitmap says which of the 32 possible children are present,
+# so the children array only holds those. assoc and dissoc copy the path from
+# the root down to the changed leaf and share everything else, so older
+# versions of a map stay valid. Keys whose hashes are equal all the way down
+# share a CollisionNode.
+#
+# Integers, BigIntegers and Strings are compared by value, every other key
+# (Symbols, which are interned, in particular) by identity.
+
+def key_hash(k):
+    if isinstance(k, Integer):
+        return k._int_val
+    elif isinstance(k, BigInteger):
+        return k._big_val.hash()
+    elif isinstance(k, String):
+        return objectmodel.compute_hash(k.str_val())
+    return objectmodel.compute_identity_hash(k)
+
+
+def bit_count(x):
+    x = x - ((x >> 1) & 0x55555555)
+    x = (x & 0x33333333) + ((x >> 2) & 0x33333333)
+    x = (x + (x >> 4)) & 0x0f0f0f0f
+    return ((x * 0x01010101) & 0xffffffff) >> 24
+
+
+def hash_bit(h, shift):
+    return 1 << ((h >> shift) & 31)
+
+
+class MapNode(object):
+    _immutable_ = True
+
+    # The value stored under key, or None
+    def find(self, shift, h, key):
+        return None
+
+    def assoc(self, shift, leaf):
+        return self
+
+    # The node without key, None once it is empty
+    def dissoc(self, shift, h, key):
+        return self
+
+    def collect(self, acc):
+        pass
+
+
+class HashedNode(MapNode):
+    _immutable_ = True
+    _hash = 0
+
+
+class Leaf(HashedNode):
+    _immutable_ = True
+
+    def __init__(self, h, key, val):
+        self._hash = h
+        self._key = key
+        self._val = val
+
+    def find(self, shift, h, key):
+        if h == self._hash and equal(key, self._key):
+            return self._val
+        return None
+
+    def assoc(self, shift, leaf):
+        if leaf._hash != self._hash:
+            return merge_nodes(shift, self, leaf)
+        if equal(leaf._key, self._key):
+            return leaf
+        return CollisionNode(self._hash, [self, leaf])
+
+    def dissoc(self, shift, h, key):
+        if h == self._hash and equal(key, self._key):
+            return None
+        return self
+
+    def collect(self, acc):
+        acc.append(self)
+
+
+class CollisionNode(HashedNode):
+    _immutable_ = True
+    _immutable_fields_ = ["_leaves[*]"]
+
+    def __init__(self, h, leaves):
+        self._hash = h
+        self._leaves = leaves
+
+    def index_of(self, key):
+        for i in range(len(self._leaves)):
+            if equal(key, self._leaves[i]._key):
+                return i
+        return -1
+
+    def find(self, shift, h, key):
+        if h != self._hash:
+            return None
+        i = self.index_of(key)
+        if i < 0:
+            return None
+        return self._leaves[i]._val
+
+    # The copies are sized up front, the leaves list has to stay fixed-size
+    def assoc(self, shift, leaf):
+        if leaf._hash != self._hash:
+            return merge_nodes(shift, self, leaf)
+        n = len(self._leaves)
+        i = self.index_of(leaf._key)
+        if i < 0:
+            i = n
+            leaves = [None] * (n + 1)
+        else:
+            leaves = [None] * n
+        for j in range(n):
+            leaves[j] = self._leaves[j]
+        leaves[i] = leaf
+        return CollisionNode(self._hash, leaves)
+
+    def dissoc(self, shift, h, key):
+        i = self.index_of(key) if h == self._hash else -1
+        if i < 0:
+            return self
+        leaves = [None] * (len(self._leaves) - 1)
+        for j in range(len(leaves)):
+            leaves[j] = self._leaves[j if j < i else j + 1]
+        if len(leaves) == 1:
+            return leaves[0]
+        return CollisionNode(self._hash, leaves)
+
+    def collect(self, acc):
+        for leaf in self._leaves:
+            acc.append(leaf)
+
+
+class BitmapNode(MapNode):
+    _immutable_ = True
+    _immutable_fields_ = ["_children[*]"]
+
+    def __init__(self, bitmap, children):
+        self._bitmap = bitmap
+        self._children = children
+
+    def position(self, bit):
+        return bit_count(self._bitmap & (bit - 1))
+
+    def find(self, shift, h, key):
+        bit = hash_bit(h, shift)
+        if self._bitmap & bit == 0:
+            return None
+        return self._children[self.position(bit)].find(shift + 5, h, key)
+
+    # Copies of children with room for one more child at pos, or with the
+    # one at pos left out. They are sized up front, children has to stay
+    # fixed-size.
+    def copied(self, insert_at=-1, remove_at=-1):
+        n = len(self._children)
+        if insert_at >= 0:
+            n += 1
+        elif remove_at >= 0:
+            n -= 1
+        children = [None] * n
+        j = 0
+        for i in range(len(self._children)):
+            if j == insert_at:
+                j += 1
+            if i != remove_at:
+                children[j] = self._children[i]
+                j += 1
+        return children
+
+    def assoc(self, shift, leaf):
+        bit = hash_bit(leaf._hash, shift)
+        pos = self.position(bit)
+        if self._bitmap & bit == 0:
+            children = self.copied(insert_at=pos)
+            children[pos] = leaf
+            return BitmapNode(self._bitmap | bit, children)
+        children = self.copied()
+        children[pos] = children[pos].assoc(shift + 5, leaf)
+        return BitmapNode(self._bitmap, children)
+
+    def dissoc(self, shift, h, key):
+        bit = hash_bit(h, shift)
+        if self._bitmap & bit == 0:
+            return self
+        pos = self.position(bit)
+        child = self._children[pos]
+        new_child = child.dissoc(shift + 5, h, key)
+        if new_child is child:
+            return self
+        if new_child is not None:
+            children = self.copied()
+            children[pos] = new_child
+            return BitmapNode(self._bitmap, children)
+        if self._bitmap == bit:
+            return None
+        return BitmapNode(self._bitmap & ~bit, self.copied(remove_at=pos))
+
+    def collect(self, acc):
+        for child in self._children:
+            child.collect(acc)
+
+
+# A node holding a and b, whose hashes differ
+def merge_nodes(shift, a, b):
+    bit_a = hash_bit(a._hash, shift)
+    bit_b = hash_bit(b._hash, shift)
+    if bit_a == bit_b:
+        return BitmapNode(bit_a, [merge_nodes(shift + 5, a, b)])
+    if bit_a < bit_b:
+        return BitmapNode(bit_a | bit_b, [a, b])
+    return BitmapNode(bit_a | bit_b, [b, a])
+
+
+class HashMap(Object):
+    _immutable_ = True
+    _type = Type("HashMap")
+
+    def __init__(self, root, count):
+        self._root = root
+        self._count = count
+
+    def to_string(self):
+        leaves = []
+        if self._root is not None:
+            self._root.collect(leaves)
+        return "{" + ", ".join([leaf._key.to_string() + " " + leaf._val.to_string() for leaf in leaves]) + "}"
+
+    def type(self):
+        return self._type
+
+    def count(self):
+        return self._count
+
+    def get(self, key):
+        if self._root is None:
+            return None
+        return self._root.find(0, key_hash(key), key)
+
+    def assoc(self, key, val):
+        h = key_hash(key)
+        leaf = Leaf(h, key, val)
+        if self._root is None:
+            return HashMap(leaf, 1)
+        count = self._count
+        if self._root.find(0, h, key) is None:
+            count += 1
+        return HashMap(self._root.assoc(0, leaf), count)
+
+    def dissoc(self, key):
+        if self.get(key) is None:
+            return self
+        return HashMap(self._root.dissoc(0, key_hash(key), key), self._count - 1)
+
+
+empty_map = HashMap(None, 0)
+
+
+# nil works as an empty map for get, assoc and dissoc
+def as_map(m):
+    if m is nil:
+        return empty_map
+    assert isinstance(m, HashMap)
+    return m
+
+
 class Fn(Object):
     _immutable_ = True
     _type = Type("Fn")
@@ -200,61 +801,63 @@ def defn(name):
 @defn("println")
 class Println(Fn):
     def invoke(self, args, stack):
-        strs = []
+        builder = StringBuilder()
         while args is not nil:
             itm = args.car()
             if isinstance(itm, String):
-                strs.append(itm._str_val)
+                itm.append_to(builder)
             else:
-                strs.append(itm.to_string())
+                builder.append(itm.to_string())
             args = args.cdr()
 
-        print("".join(strs))
+        print(builder.build())
         return nil, stack
 
 
 @defn("load-file")
 class LoadFile(Fn):
     def invoke(self, args, stack):
-        rdr = PushbackReader(FileReader(args.car()._str_val))
-        forms = read_all(rdr)
+        forms = load_forms(args.car().str_val())
+        check_loops(forms)
         return nil, stack.push(EvalExpr(nil, forms))
 
 
 @defn("<")
 class LessThan(Fn):
     def invoke(self, args, stack):
-        return true if args.car()._int_val < args.cdr().car()._int_val else false, stack
+        return ordered(args, -1, -1), stack
 
 
 @defn(">")
 class GreaterThan(Fn):
     def invoke(self, args, stack):
-        return true if args.car()._int_val > args.cdr().car()._int_val else false, stack
+        return ordered(args, 1, 1), stack
 
 
 @defn("<=")
 class LessThanOrEqual(Fn):
     def invoke(self, args, stack):
-        return true if args.car()._int_val <= args.cdr().car()._int_val else false, stack
+        return ordered(args, -1, 0), stack
 
 
 @defn(">=")
 class GreaterThanOrEqual(Fn):
     def invoke(self, args, stack):
-        return true if args.car()._int_val >= args.cdr().car()._int_val else false, stack
+        return ordered(args, 0, 1), stack
 
 
 @defn("=")
 class Equal(Fn):
     def invoke(self, args, stack):
-        a = args.car()
-        b = args.cdr().car()
-
-        if isinstance(a, Integer) and isinstance(b, Integer):
-            return true if a._int_val == b._int_val else false, stack
-        else:
-            return true if a is b else false, stack
+        if args is nil:
+            return true, stack
+        first = args.car()
+        args = args.cdr()
+        while args is not nil:
+            if not equal(first, args.car()):
+                return false, stack
+            args = args.cdr()
+        return true, stack
 
 
 @defn("car")
@@ -289,35 +892,177 @@ class SymbolQ(Fn):
     def invoke(self, args, stack):
         return true if isinstance(args.car(), Symbol) else false, stack
 
+@defn("vector")
+class VectorFn(Fn):
+    def invoke(self, args, stack):
+        return Vector.from_cons(args), stack
+
+# nth and count also take lists, walking them, and count takes maps and
+# strings
+@defn("nth")
+class Nth(Fn):
+    def invoke(self, args, stack):
+        coll = args.car()
+        index = args.cdr().car()
+        assert isinstance(index, Integer)
+        i = index.int_val()
+        if isinstance(coll, Vector):
+            return coll.nth(i), stack
+        while i > 0 and coll is not nil:
+            coll = coll.cdr()
+            i -= 1
+        if i != 0 or coll is nil:
+            print("Index out of bounds: %d" % index.int_val())
+            raise IndexError
+        return coll.car(), stack
+
+@defn("count")
+class Count(Fn):
+    def invoke(self, args, stack):
+        coll = args.car()
+        if isinstance(coll, Vector):
+            return make_int(coll.count()), stack
+        elif isinstance(coll, HashMap):
+            return make_int(coll.count()), stack
+        elif isinstance(coll, String):
+            return make_int(coll._length), stack
+        return make_int(list_length(coll)), stack
+
+# Adds to the end of a vector and to the front of a list
+@defn("conj")
+class Conj(Fn):
+    def invoke(self, args, stack):
+        coll = args.car()
+        args = args.cdr()
+        if isinstance(coll, Vector):
+            return coll.conj(args), stack
+        while args is not nil:
+            coll = Cons(args.car(), coll)
+            args = args.cdr()
+        return coll, stack
+
+@defn("hash-map")
+class HashMapFn(Fn):
+    def invoke(self, args, stack):
+        m = empty_map
+        while args is not nil:
+            m = m.assoc(args.car(), args.cdr().car())
+            args = args.cdr().cdr()
+        return m, stack
+
+# (get m k) is nil if m has no k, (get m k default) is default then
+@defn("get")
+class Get(Fn):
+    def invoke(self, args, stack):
+        val = as_map(args.car()).get(args.cdr().car())
+        if val is not None:
+            return val, stack
+        default = args.cdr().cdr()
+        if default is nil:
+            return nil, stack
+        return default.car(), stack
+
+@defn("assoc")
+class Assoc(Fn):
+    def invoke(self, args, stack):
+        m = as_map(args.car())
+        args = args.cdr()
+        while args is not nil:
+            m = m.assoc(args.car(), args.cdr().car())
+            args = args.cdr().cdr()
+        return m, stack
+
+@defn("dissoc")
+class Dissoc(Fn):
+    def invoke(self, args, stack):
+        m = as_map(args.car())
+        args = args.cdr()
+        while args is not nil:
+            m = m.dissoc(args.car())
+            args = args.cdr()
+        return m, stack
+
+@defn("str")
+class Str(Fn):
+    def invoke(self, args, stack):
+        acc = empty_string
+        while args is not nil:
+            acc = concat(acc, as_string(args.car()))
+            args = args.cdr()
+        return acc, stack
+
+@defn("str-concat")
+class StrConcat(Fn):
+    def invoke(self, args, stack):
+        acc = empty_string
+        while args is not nil:
+            s = args.car()
+            assert isinstance(s, String)
+            acc = concat(acc, s)
+            args = args.cdr()
+        return acc, stack
+
+# (subs s start) or (subs s start end), end exclusive
+@defn("subs")
+class Subs(Fn):
+    def invoke(self, args, stack):
+        s = args.car()
+        start = args.cdr().car()
+        rest = args.cdr().cdr()
+        assert isinstance(s, String)
+        assert isinstance(start, Integer)
+        end = s._length
+        if rest is not nil:
+            end_val = rest.car()
+            assert isinstance(end_val, Integer)
+            end = end_val.int_val()
+        return s.substring(start.int_val(), end), stack
+
+zero = make_int(0)
+one = make_int(1)
+
 @defn("inc")
 class Inc(Fn):
     def invoke(self, args, stack):
-        return Integer(args.car().int_val() + 1), stack
+        return add(args.car(), one), stack
 
 @defn("dec")
 class Inc(Fn):
     def invoke(self, args, stack):
-        return Integer(args.car().int_val() - 1), stack
+        return sub(args.car(), one), stack
 
 @defn("+")
 class Add(Fn):
     def invoke(self, args, stack):
-        return Integer(args.car().int_val() + args.cdr().car().int_val()), stack
+        return add_all(0, args), stack
 
+# (- x) negates x, (- x y z) is x minus the sum of the rest
 @defn("-")
 class Sub(Fn):
     def invoke(self, args, stack):
-        return Integer(args.car().int_val() - args.cdr().car().int_val()), stack
+        rest = args.cdr()
+        if rest is nil:
+            return sub(zero, args.car()), stack
+        return sub(args.car(), add_all(0, rest)), stack
 
 @defn("*")
 class Mul(Fn):
     def invoke(self, args, stack):
-        return Integer(args.car().int_val() * args.cdr().car().int_val()), stack
+        return mul_all(1, args), stack
 
 @defn("/")
 class Div(Fn):
     def invoke(self, args, stack):
-        return Integer(args.car().int_val() / args.cdr().car().int_val()), stack
+        acc = args.car()
+        args = args.cdr()
+        # A single argument gets its reciprocal, 1 divided by it, like - of
+        # a single argument negates it
+        if args is nil:
+            return div(one, acc), stack
+        while args is not nil:
+            acc = div(acc, args.car())
+            args = args.cdr()
+        return acc, stack
 
 @defn("vararg")
 class VarArg(Fn):
@@ -340,8 +1085,12 @@ class Die(Fn):
 @defn("read-file")
 class ReadFile(Fn):
     def invoke(self, args, stack):
-        rdr = PushbackReader(FileReader(args.car()._str_val))
-        return read_all(rdr), stack
+        return load_forms(args.car().str_val()), stack
+
+@defn("parse-cache-stats")
+class ParseCacheStats(Fn):
+    def invoke(self, args, stack):
+        return Cons.from_list([make_int(parsed_files.hits), make_int(parsed_files.misses)]), stack
 
 
 class VarArgLambda(Fn):
@@ -359,23 +1108,109 @@ class VarArgLambda(Fn):
 # Reader Begins
 
 class Reader(object):
+    # The line the next character is on, counted by the reader functions as
+    # they skip newlines
+    def __init__(self):
+        self.line = 1
+
     def read(self):
         return -1
 
+    def unread(self, ch):
+        pass
+
+    # Readers backed by an in-memory view of the whole file return their
+    # current index, so tokens can be sliced out instead of built per char
+    def mark(self):
+        return -1
+
+    def slice(self, start, end):
+        return ""
+
+    def close(self):
+        pass
+
 
 class FileReader(Reader):
+    block_size = 64 * 1024
+
     def __init__(self, file_name):
+        Reader.__init__(self)
         self._file = streamio.open_file_as_stream(file_name)
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            raise EOFError()
+        self._buf = self._file.read(self.block_size)
+        self._pos = 0
+        if len(self._buf) == 0:
+            self.close()
+            raise EOFError()
+
+    def read(self):
+        if self._pos >= len(self._buf):
+            self._fill()
+        ch = self._buf[self._pos]
+        self._pos += 1
+        return ord(ch)
+
+    def close(self):
+        if not self._eof:
+            self._eof = True
+            self._file.close()
+
+
+class MappedFileReader(Reader):
+    def __init__(self, file_name):
+        Reader.__init__(self)
+        fd = os.open(file_name, os.O_RDONLY, 0)
+        try:
+            self._map = rmmap.mmap(fd, 0, access=rmmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        self._size = self._map.len()
+        self._pos = 0
+        self._closed = False
 
     def read(self):
-        ch = self._file.read(1)
-        if len(ch) == 0:
+        if self._pos >= self._size:
             raise EOFError()
-        return ord(ch[0])
+        ch = self._map.getitem(self._pos)
+        self._pos += 1
+        return ord(ch)
+
+    def unread(self, ch):
+        self._pos -= 1
+
+    def mark(self):
+        return self._pos
+
+    def slice(self, start, end):
+        return self._map.getslice(start, end - start)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._map.close()
+
+
+# Files at least this big are parsed straight out of a memory mapping. An
+# empty file can't be mapped, so it's always read as a stream.
+mmap_threshold = 1024 * 1024
+
+def open_reader(file_name):
+    size = os.stat(file_name).st_size
+    if size > 0 and size >= mmap_threshold:
+        return MappedFileReader(file_name)
+    return PushbackReader(FileReader(file_name))
 
 
 class PushbackReader(Reader):
     def __init__(self, inner):
+        Reader.__init__(self)
         self._inner = inner
         self._has_unread = False
         self._unread_char = 0
@@ -392,42 +1227,58 @@ class PushbackReader(Reader):
         self._has_unread = True
         self._unread_char = ch
 
+    def close(self):
+        self._inner.close()
+
 
 def list_reader(terminator):
     def list_reader_inner(rdr):
-        ch = rdr.read()
-
-        while ch in whitespace:
-            ch = rdr.read()
+        line = rdr.line
+        ch = skip_whitespace(rdr, rdr.read())
 
         acc = []
         while True:
             if ch == terminator:
-                return Cons.from_list(acc)
-
-            rdr.unread(ch)
+                return source_list(acc, line)
 
-            acc.append(read(rdr))
+            # The bindings of fn, let and loop stay lists
+            if ch == ord("[") and len(acc) == 1 and acc[0] in binding_forms:
+                acc.append(binding_reader(rdr))
+            else:
+                rdr.unread(ch)
+                acc.append(read(rdr))
 
-            ch = rdr.read()
+            ch = skip_whitespace(rdr, rdr.read())
 
 
     return list_reader_inner
 
+binding_reader = list_reader(ord("]"))
+
+def vector_reader(rdr):
+    return Vector.from_cons(binding_reader(rdr))
+
 def string_reader(rdr):
+    start = rdr.mark()
     acc = []
     ch = rdr.read()
     while ch != ord("\""):
-        acc.append(chr(ch))
+        if ch == newline:
+            rdr.line += 1
+        if start < 0:
+            acc.append(chr(ch))
         ch = rdr.read()
 
-    return String("".join(acc))
+    if start < 0:
+        return String("".join(acc))
+    return String(rdr.slice(start, rdr.mark() - 1))
 
 def comment_reader(rdr):
     ch = rdr.read()
-    while ch != ord("\n"):
+    while ch != newline:
         ch = rdr.read()
 
+    rdr.line += 1
     return None
 
 quote_sym = Symbol.intern("quote")
@@ -438,37 +1289,77 @@ fn_sym = Symbol.intern("fn")
 cond_sym = Symbol.intern("cond")
 resolve_sym = Symbol.intern("resolve")
 let_sym = Symbol.intern("let")
+loop_sym = Symbol.intern("loop")
+recur_sym = Symbol.intern("recur")
+
+binding_forms = {fn_sym: True, let_sym: True, loop_sym: True}
 
 
 def quote_reader(rdr):
     return Cons.from_list([quote_sym, read(rdr)])
 
-def str_to_ints(str):
-    return list(map(ord, str))
-
-whitespace = list(map(ord, "\n\t \r,"))
-
 macros = {ord("("): list_reader(ord(")")),
-          ord("["): list_reader(ord("]")),
+          ord("["): vector_reader,
           ord("\""): string_reader,
           ord(";"): comment_reader,
           ord("'"): quote_reader}
 
-alphanums = str_to_ints("1234567890abcdefghijklmnopqrstuvwxyz_!-+*/<>=?")
+# Every character the reader sees is classified by indexing these 256 entry
+# tables instead of scanning lists of characters
+WHITESPACE = 1
+SYMBOL = 2
+DIGIT = 4
+MACRO = 8
+
+char_classes = [0] * 256
+macro_table = [None] * 256
+
+def add_char_class(chars, flag):
+    for ch in chars:
+        char_classes[ord(ch)] |= flag
+
+add_char_class("\n\t \r,", WHITESPACE)
+add_char_class("1234567890abcdefghijklmnopqrstuvwxyz_!-+*/<>=?", SYMBOL)
+add_char_class("1234567890", DIGIT)
+
+for ch, macro in macros.items():
+    char_classes[ch] |= MACRO
+    macro_table[ch] = macro
+
+def is_whitespace(ch):
+    return char_classes[ch] & WHITESPACE != 0
 
-nums = str_to_ints("1234567890")
+newline = ord("\n")
+
+# Returns the first character from ch on that isn't whitespace
+def skip_whitespace(rdr, ch):
+    while is_whitespace(ch):
+        if ch == newline:
+            rdr.line += 1
+        ch = rdr.read()
+    return ch
+
+def is_symbol_char(ch):
+    return char_classes[ch] & SYMBOL != 0
+
+def is_digit(ch):
+    return char_classes[ch] & DIGIT != 0
 
 def symbol_reader(rdr, start):
+    begin = rdr.mark() - 1
     acc = []
     ch = start
 
-    while ch in alphanums:
-        acc.append(chr(ch))
+    while is_symbol_char(ch):
+        if begin < 0:
+            acc.append(chr(ch))
         ch = rdr.read()
 
     rdr.unread(ch)
 
-    return interpret_symbol("".join(acc))
+    if begin < 0:
+        return interpret_symbol("".join(acc))
+    return interpret_symbol(rdr.slice(begin, rdr.mark()))
 
 direct_mappings = {"true": true,
                    "false": false,
@@ -479,21 +1370,21 @@ def interpret_symbol(sym):
     if direct is not None:
         return direct
 
-    if ord(sym[0]) in nums or (sym[0] == "-" and len(sym) > 1 and ord(sym[1]) in nums):
-        return Integer(int(sym))
+    if is_digit(ord(sym[0])) or (sym[0] == "-" and len(sym) > 1 and is_digit(ord(sym[1]))):
+        digits = len(sym) - 1 if sym[0] == "-" else len(sym)
+        if digits < 18:
+            return make_int(int(sym))
+        return make_big(rbigint.fromdecimalstr(sym))
     return Symbol.intern(sym)
 
 
 def read(rdr):
 
     while True:
-        ch = rdr.read()
-        while ch in whitespace:
-            ch = rdr.read()
+        ch = skip_whitespace(rdr, rdr.read())
 
-        macro = macros.get(ch, None)
-        if macro is not None:
-            result = macro(rdr)
+        if char_classes[ch] & MACRO != 0:
+            result = macro_table[ch](rdr)
 
             if result is None:
                 continue
@@ -509,26 +1400,437 @@ def read_all(rdr):
             acc.append(read(rdr))
         except EOFError:
             return Cons.from_list(acc)
+
+# Closes the reader also when parsing fails, so a syntax error doesn't leak
+# the file or its mapping
+def read_all_and_close(rdr):
+    try:
+        return read_all(rdr)
+    finally:
+        rdr.close()
 # End of Reader Code
 
+# Parsed form cache
+#
+# load_forms keeps a binary dump of each file's parsed forms next to the source
+# (foo.clj -> foo.clj.cache), stamped with the source size and mtime. As long
+# as those match, loading the file decodes the dump instead of running read_all.
+#
+# Layout: magic, source size, source mtime (ms), then one tagged form. Varints
+# are little endian base 128. Symbols are written by name the first time they
+# appear and by index after that. BigIntegers are written in decimal.
+# Vectors are written like proper lists, under their own tag, and so are lists
+# the reader made, with the line they started on in front.
+
+cache_magic = "LIXC\x03"
+cache_suffix = ".cache"
+
+
+class CacheError(Exception):
+    pass
+
+
+class FormEncoder(object):
+    def __init__(self, stream):
+        self._stream = stream
+        self._out = []
+        self._symbols = {}
+
+    def flush(self):
+        self._stream.write("".join(self._out))
+        self._out = []
+
+    def write_varint(self, v):
+        assert v >= 0
+        while v >= 0x80:
+            self._out.append(chr((v & 0x7f) | 0x80))
+            v >>= 7
+        self._out.append(chr(v))
+
+    def write_bytes(self, s):
+        self._out.append(s)
+
+    def write_str(self, s):
+        self.write_varint(len(s))
+        self.write_bytes(s)
+
+    def write_form(self, form):
+        if len(self._out) >= 4096:
+            self.flush()
+
+        if form is nil:
+            self._out.append("n")
+        elif form is true:
+            self._out.append("t")
+        elif form is false:
+            self._out.append("f")
+        elif isinstance(form, Integer):
+            if form._int_val >= 0:
+                self._out.append("i")
+                self.write_varint(form._int_val)
+            else:
+                self._out.append("j")
+                self.write_varint(-(form._int_val + 1))
+        elif isinstance(form, BigInteger):
+            self._out.append("b")
+            self.write_str(form._big_val.str())
+        elif isinstance(form, String):
+            self._out.append("s")
+            self.write_str(form.str_val())
+        elif isinstance(form, Symbol):
+            idx = self._symbols.get(form, -1)
+            if idx < 0:
+                self._symbols[form] = len(self._symbols)
+                self._out.append("S")
+                self.write_str(form._str_val)
+            else:
+                self._out.append("y")
+                self.write_varint(idx)
+        elif isinstance(form, Vector):
+            self._out.append("v")
+            self.write_varint(len(form._items))
+            for itm in form._items:
+                self.write_form(itm)
+        elif isinstance(form, Cons):
+            items = []
+            c = form
+            while isinstance(c, Cons):
+                items.append(c.car())
+                c = c.cdr()
+            if c is nil:
+                if isinstance(form, SourceCons):
+                    self._out.append("L")
+                    self.write_varint(form.line())
+                else:
+                    self._out.append("l")
+                self.write_varint(len(items))
+                for itm in items:
+                    self.write_form(itm)
+            else:
+                self._out.append("c")
+                self.write_form(form.car())
+                self.write_form(form.cdr())
+        else:
+            raise CacheError()
+
+
+class FormDecoder(object):
+    def __init__(self, data):
+        self._data = data
+        self._size = len(data)
+        self._pos = 0
+        self._symbols = []
+
+    def char_at(self, pos):
+        return self._data[pos]
+
+    def slice(self, start, end):
+        return self._data[start:end]
+
+    def read_byte(self):
+        if self._pos >= self._size:
+            raise CacheError()
+        ch = self.char_at(self._pos)
+        self._pos += 1
+        return ch
+
+    def read_varint(self):
+        v = 0
+        shift = 0
+        while True:
+            b = ord(self.read_byte())
+            v |= (b & 0x7f) << shift
+            if b < 0x80:
+                return v
+            shift += 7
+            # More continuation bytes than a machine word holds
+            if shift > 63:
+                raise CacheError()
+
+    def read_str(self):
+        length = self.read_varint()
+        start = self._pos
+        end = start + length
+        if end > self._size:
+            raise CacheError()
+        assert start >= 0 and end >= 0
+        self._pos = end
+        return self.slice(start, end)
+
+    def expect(self, s):
+        for ch in s:
+            if self.read_byte() != ch:
+                raise CacheError()
+
+    def at_end(self):
+        return self._pos == self._size
+
+    def read_form(self):
+        tag = self.read_byte()
+        if tag == "n":
+            return nil
+        elif tag == "t":
+            return true
+        elif tag == "f":
+            return false
+        elif tag == "i":
+            return make_int(self.read_varint())
+        elif tag == "j":
+            return make_int(-self.read_varint() - 1)
+        elif tag == "b":
+            return make_big(rbigint.fromdecimalstr(self.read_str()))
+        elif tag == "s":
+            return String(self.read_str())
+        elif tag == "S":
+            sym = Symbol.intern(self.read_str())
+            self._symbols.append(sym)
+            return sym
+        elif tag == "y":
+            idx = self.read_varint()
+            if idx >= len(self._symbols):
+                raise CacheError()
+            return self._symbols[idx]
+        elif tag == "l":
+            count = self.read_varint()
+            items = []
+            for i in range(count):
+                items.append(self.read_form())
+            return Cons.from_list(items)
+        elif tag == "L":
+            line = self.read_varint()
+            count = self.read_varint()
+            if count == 0:
+                raise CacheError()
+            items = []
+            for i in range(count):
+                items.append(self.read_form())
+            return source_list(items, line)
+        elif tag == "v":
+            count = self.read_varint()
+            items = [None] * count
+            for i in range(count):
+                items[i] = self.read_form()
+            return Vector(items)
+        elif tag == "c":
+            car = self.read_form()
+            return Cons(car, self.read_form())
+        raise CacheError()
+
+
+# Decodes straight out of a memory mapping of the cache, so a big cache is
+# never copied into a string first. Every string it returns is a copy, so
+# the forms outlive the mapping.
+class MappedFormDecoder(FormDecoder):
+    def __init__(self, mapping):
+        FormDecoder.__init__(self, "")
+        self._map = mapping
+        self._size = mapping.len()
+
+    def char_at(self, pos):
+        return self._map.getitem(pos)
+
+    def slice(self, start, end):
+        return self._map.getslice(start, end - start)
+
+
+# Caches as big as mmap_threshold are mapped like their sources, smaller
+# ones are read into a string
+def read_cached_forms(cache_name, size, mtime):
+    try:
+        cache_size = os.stat(cache_name).st_size
+        if cache_size > 0 and cache_size >= mmap_threshold:
+            return read_mapped_cache(cache_name, size, mtime)
+        f = streamio.open_file_as_stream(cache_name)
+        try:
+            data = f.readall()
+        finally:
+            f.close()
+    except (OSError, streamio.StreamError, rmmap.RMMapError):
+        return None
+    return decode_cache(FormDecoder(data), size, mtime)
+
+
+def read_mapped_cache(cache_name, size, mtime):
+    fd = os.open(cache_name, os.O_RDONLY, 0)
+    try:
+        mapping = rmmap.mmap(fd, 0, access=rmmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+    try:
+        return decode_cache(MappedFormDecoder(mapping), size, mtime)
+    finally:
+        mapping.close()
+
+
+def decode_cache(decoder, size, mtime):
+    try:
+        decoder.expect(cache_magic)
+        if decoder.read_varint() != size or decoder.read_varint() != mtime:
+            return None
+        forms = decoder.read_form()
+        if not decoder.at_end():
+            return None
+        return forms
+    except CacheError:
+        return None
+
+
+def write_cached_forms(cache_name, size, mtime, forms):
+    # Written under a temporary name and renamed so a concurrent reader
+    # never sees half a file
+    tmp_name = cache_name + ".tmp"
+    try:
+        f = streamio.open_file_as_stream(tmp_name, "w")
+        try:
+            encoder = FormEncoder(f)
+            encoder.write_bytes(cache_magic)
+            encoder.write_varint(size)
+            encoder.write_varint(mtime)
+            encoder.write_form(forms)
+            encoder.flush()
+        finally:
+            f.close()
+        os.rename(tmp_name, cache_name)
+    except (CacheError, OSError, streamio.StreamError):
+        remove_file(tmp_name)
+
+
+# Removes a file that may not exist or may not be removable
+def remove_file(file_name):
+    try:
+        os.unlink(file_name)
+    except OSError:
+        pass
+
+
+class ParsedFile(object):
+    def __init__(self, size, mtime, forms):
+        self.size = size
+        self.mtime = mtime
+        self.forms = forms
+
+
+class ParsedFiles(object):
+    # In-process table of parsed files, so loading the same file again in
+    # the same run skips the disk entirely. Entries are dropped once the file
+    # changes, or least recently used first once there are `capacity` of them.
+
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._entries = {}
+        self._order = []
+        self.hits = 0
+        self.misses = 0
+
+    def _touch(self, file_name):
+        if file_name in self._order:
+            self._order.remove(file_name)
+        self._order.append(file_name)
+
+    def get(self, file_name, size, mtime):
+        entry = self._entries.get(file_name, None)
+        if entry is not None and entry.size == size and entry.mtime == mtime:
+            self.hits += 1
+            self._touch(file_name)
+            return entry.forms
+
+        self.misses += 1
+        return None
+
+    def put(self, file_name, size, mtime, forms):
+        self._entries[file_name] = ParsedFile(size, mtime, forms)
+        self._touch(file_name)
+        while len(self._order) > self._capacity:
+            del self._entries[self._order.pop(0)]
+
+
+parsed_files = ParsedFiles(32)
+
+
+def load_forms(file_name):
+    st = os.stat(file_name)
+    size = st.st_size
+    mtime = int(st.st_mtime * 1000)
+
+    forms = parsed_files.get(file_name, size, mtime)
+    if forms is not None:
+        return forms
+
+    cache_name = file_name + cache_suffix
+    forms = read_cached_forms(cache_name, size, mtime)
+    if forms is None:
+        forms = read_all_and_close(open_reader(file_name))
+        write_cached_forms(cache_name, size, mtime, forms)
+
+    parsed_files.put(file_name, size, mtime, forms)
+    return forms
+
 # Start of Interpreter
 
-class Stack(object):
-    _immutable_ = True
-    def __init__(self, k=None, prev=None):
-        self._k = k
+segment_size = 256
+
+
+class Segment(object):
+    def __init__(self, prev):
+        self._items = [None] * segment_size
         self._prev = prev
 
+
+# The continuation stack, kept in fixed-size array segments linked to the
+# ones below them. Unlike a linked list of frames, pushing only allocates
+# when a segment fills up, and one emptied segment is kept around so a
+# stack bouncing on a segment boundary doesn't allocate either.
+#
+# push and pop mutate the stack in place, so each stack has a single owner:
+# nothing captures a continuation to resume it later, and a stack is never
+# shared between two evaluations.
+class Stack(object):
+    def __init__(self):
+        self._segment = None
+        self._top = segment_size
+        self._spare = None
+
+    # push and pop get inlined into the evaluator, crossing into another
+    # segment is kept out of line
+    @objectmodel.always_inline
     def push(self, k):
-        return Stack(k, self)
+        if self._top == segment_size:
+            self._next_segment()
+        self._segment._items[self._top] = k
+        self._top += 1
+        return self
 
+    @objectmodel.always_inline
     def pop(self):
-        return self._k, self._prev
+        self._top -= 1
+        items = self._segment._items
+        k = items[self._top]
+        items[self._top] = None
+        if self._top == 0:
+            self._prev_segment()
+        return k
+
+    @objectmodel.dont_inline
+    def _next_segment(self):
+        segment = self._spare
+        if segment is None:
+            segment = Segment(self._segment)
+        else:
+            segment._prev = self._segment
+        self._spare = None
+        self._segment = segment
+        self._top = 0
+
+    @objectmodel.dont_inline
+    def _prev_segment(self):
+        segment = self._segment
+        self._segment = segment._prev
+        self._top = segment_size
+        segment._prev = None
+        self._spare = segment
 
     def has_more(self):
-        return self._k is not None
-
-tos = Stack()
+        return self._segment is not None
 
 class Continuation(object):
     _immutable_ = True
@@ -563,9 +1865,9 @@ class EvalApply(Continuation):
                 args = Cons(val)
 
                 for x in range(self._expr_count - 2):
-                    k, stack = stack.pop()
+                    k = stack.pop()
                     args = Cons(k.val(), args)
-                k, stack = stack.pop()
+                k = stack.pop()
                 f = k.val()
             return f.invoke(args, stack)
 
@@ -690,6 +1992,102 @@ class Lambda(Fn):
 
         return nil, stack.push(EvalExpr(new_env, self._body))
 
+# Bound in the env by loop and fn. No symbol the reader makes is either of
+# them, so programs can't refer to them.
+loop_marker = Symbol("loop")
+fn_marker = Symbol("fn")
+
+# The recur Lambda of the innermost loop around env, if there is one inside
+# the current fn. Outside of one, recur is an ordinary call.
+def find_loop(env):
+    e = env
+    while e is not nil:
+        k = e.car().car()
+        if k is loop_marker:
+            return e.car().cdr()
+        elif k is fn_marker:
+            return None
+        e = e.cdr()
+    return None
+
+
+class CompileError(Exception):
+    pass
+
+
+# The recur checks compile_form does in the JIT interpreter, done over a
+# whole file before any of it runs
+def check_loops(form):
+    if isinstance(form, Vector):
+        for itm in form._items:
+            check_loops(itm)
+    elif isinstance(form, Cons):
+        if form.car() is quote_sym:
+            return
+        elif form.car() is loop_sym:
+            count = 0
+            binds = form.cdr().car()
+            while binds is not nil:
+                count += 1
+                binds = binds.cdr().cdr()
+            check_each(form.cdr().cdr(), count, True)
+        while isinstance(form, Cons):
+            check_loops(form.car())
+            form = form.cdr()
+
+# Each recur of a loop is in tail position of its body and passes one value
+# per binding. A nested loop's body has recurs of its own, and a nested fn
+# can't recur to this loop.
+def check_recurs(form, count, tail):
+    if isinstance(form, Vector):
+        for itm in form._items:
+            check_recurs(itm, count, False)
+        return
+    elif not isinstance(form, Cons):
+        return
+
+    head = form.car()
+    args = form.cdr()
+    if head is quote_sym or head is fn_sym:
+        return
+    elif head is if_sym:
+        check_recurs(args.car(), count, False)
+        check_each(args.cdr(), count, tail, tail)
+    elif head is do_sym:
+        check_each(args, count, tail)
+    elif head is let_sym or head is loop_sym:
+        binds = args.car()
+        while binds is not nil:
+            check_recurs(binds.cdr().car(), count, False)
+            binds = binds.cdr().cdr()
+        if head is let_sym:
+            check_each(args.cdr(), count, tail)
+    elif head is cond_sym:
+        is_body = False
+        while args is not nil:
+            check_recurs(args.car(), count, tail and is_body)
+            is_body = not is_body
+            args = args.cdr()
+    elif head is recur_sym:
+        if not tail:
+            print("Can only recur from tail position: " + form.to_string())
+            raise CompileError()
+        if list_length(args) != count:
+            print("Mismatched argument count to recur, expected %d args, got %d: %s"
+                  % (count, list_length(args), form.to_string()))
+            raise CompileError()
+        check_each(args, count, False)
+    else:
+        check_each(form, count, False)
+
+# tail says whether the last form is in tail position, all_tail whether the
+# others are too
+def check_each(forms, count, tail, all_tail=False):
+    while forms is not nil:
+        is_last = forms.cdr() is nil
+        check_recurs(forms.car(), count, all_tail or (tail and is_last))
+        forms = forms.cdr()
+
 def eval_sexpr(env, sym, args, stack):
     if sym is if_sym:
         return nil, stack.push(IfContinuation(env, args.cdr().car(), args.cdr().cdr().car())) \
@@ -712,14 +2110,60 @@ def eval_sexpr(env, sym, args, stack):
         body = args.cdr()
         return nil, stack.push(LetContinuation(env, binds.car(), binds.cdr().cdr(), body)) \
                          .push(EvalExpr(env, binds.cdr().car()))
+    elif sym is loop_sym:
+        # The body runs like a let's, with a Lambda over the binding names
+        # that runs the body again bound under loop_marker, for recur to
+        # call. Calling it from tail position doesn't grow the stack.
+        binds = args.car()
+        body = args.cdr()
+        syms = []
+        rest = binds
+        while rest is not nil:
+            syms.append(rest.car())
+            rest = rest.cdr().cdr()
+        recur_fn = Lambda(nil, Cons.from_list(syms), Cons(do_sym, body))
+        loop_env = Cons(Cons(loop_marker, recur_fn), env)
+        recur_fn._env = loop_env
+        if binds is nil:
+            return nil, stack.push(DoContinuation(loop_env, body))
+        return nil, stack.push(LetContinuation(loop_env, binds.car(), binds.cdr().cdr(), body)) \
+                         .push(EvalExpr(loop_env, binds.cdr().car()))
+    elif sym is recur_sym:
+        recur_fn = find_loop(env)
+        if recur_fn is not None:
+            return nil, stack.push(EvalApply(env, args)) \
+                             .push(EvalExpr(env, recur_fn))
     elif sym is fn_sym:
         arg_list = args.car()
         body = Cons(do_sym, args.cdr())
+        # A fn can't recur to a loop around it
+        if find_loop(env) is not None:
+            env = Cons(Cons(fn_marker, nil), env)
         return Lambda(env, arg_list, body), stack
 
+    # A builtin called with simple arguments is invoked directly, skipping
+    # the EvalApply steps, unless sym is bound locally or has been redefined
+    builtin = global_fns.get(sym, None)
+    if builtin is not None and all_simple(args) and lookup(env, sym) is builtin:
+        return builtin.invoke(eval_simple_args(env, args, stack), stack)
     return nil, stack.push(EvalApply(env, args)) \
                      .push(EvalExpr(env, sym))
 
+# Constants and symbols evaluate without pushing anything
+def all_simple(args):
+    while args is not nil:
+        arg = args.car()
+        if isinstance(arg, Cons) or isinstance(arg, Vector):
+            return False
+        args = args.cdr()
+    return True
+
+def eval_simple_args(env, args, stack):
+    if args is nil:
+        return nil
+    val, _ = eval_one(env, args.car(), stack)
+    return Cons(val, eval_simple_args(env, args.cdr(), stack))
+
 def eval_one(env, expr, stack):
     if isinstance(expr, Cons):
         if isinstance(expr.car(), Symbol):
@@ -727,24 +2171,46 @@ def eval_one(env, expr, stack):
         else:
             return nil, stack.push(EvalApply(env, expr.cdr())) \
                              .push(EvalExpr(env, expr.car()))
+    elif isinstance(expr, Vector):
+        # Evaluates the items and calls the vector builtin on them. The
+        # items are walked by index, since _items is fixed-size.
+        items = nil
+        i = len(expr._items) - 1
+        while i >= 0:
+            items = Cons(expr._items[i], items)
+            i -= 1
+        return nil, stack.push(EvalApply(env, items)) \
+                         .push(EvalExpr(env, VectorFn))
     elif isinstance(expr, Symbol):
         return lookup(env, expr), stack
     else:
         return expr, stack
 
 class Globals(object):
-    _immutable_fields_ = ["_globals"]
+    # Globals live in the cells of their Symbols. This only remembers which
+    # cells have been defined, so clear can empty them again.
     def __init__(self):
-        self._globals = {}
+        self._defined = []
 
     def def_global(self, k, v):
-        self._globals[k] = v
+        assert isinstance(k, Symbol)
+        cell = k._cell
+        if cell.get() is None:
+            self._defined.append(cell)
+        cell.set(v)
 
     def get_global(self, k):
-        return self._globals[k]
+        assert isinstance(k, Symbol)
+        val = k._cell.get()
+        if val is None:
+            print("Global not defined: " + k._str_val)
+            raise KeyError
+        return val
 
     def clear(self):
-        self._globals.clear()
+        for cell in self._defined:
+            cell.set(None)
+        self._defined = []
 
 global_registry = Globals()
 
@@ -768,11 +2234,11 @@ def lookup(env, k):
 
 def eval_all(expr):
     env = nil
-    stack = tos
+    stack = Stack()
     val, stack = eval_one(env, expr, stack)
 
     while stack.has_more():
-        k, stack = stack.pop()
+        k = stack.pop()
         val, stack = k.call_continuation(val, stack)
 
     return val
@@ -781,9 +2247,13 @@ def eval_all(expr):
 # Entry Point code
 
 def run(filename):
-    rdr = PushbackReader(FileReader(filename))
-    forms = read_all(rdr)
-    result = eval_all(forms)
+    forms = load_forms(filename)
+    try:
+        check_loops(forms)
+        result = eval_all(forms)
+    except CompileError:
+        # Raised by this file or one it loads, after printing what's wrong
+        return 1
 
 
     return 0
@@ -1,7 +1,15 @@
 import sys
 sys.path.append("../pypy")
+import os
+import time
 import rpython.rlib.streamio as streamio
+import rpython.rlib.rmmap as rmmap
+from rpython.rlib.rarithmetic import ovfcheck
+from rpython.rlib.rbigint import rbigint
+import rpython.rlib.objectmodel as objectmodel
+from rpython.rlib.rstring import StringBuilder
 import rpython.rlib.jit as jit
+import rpython.rlib.jit_hooks as jit_hooks
 
 # To compile with a JIT:
 # ../pypy/rpython/bin/rpython --opt=jit src/lisp_in_x/in_rpython_jit.py
@@ -23,6 +31,16 @@ class Object(object):
     def __repr__(self):
         return self.to_string()
 
+    # Called with the evaluated fn in vals[0] and its arguments after it
+    @jit.unroll_safe
+    def invoke_vals(self, vals, stack):
+        args = nil
+        i = len(vals) - 1
+        while i > 0:
+            args = Cons(vals[i], args)
+            i -= 1
+        return self.invoke(args, stack)
+
     def invoke(self, args, stack):
         print("Can't invoke %s with args %s, object of type %s is uncallable" % (self.to_string(), args.to_string(),
                                                                                  self.type().to_string()))
@@ -61,19 +79,293 @@ class Integer(Object):
         return self._int_val
 
 
+small_int_min = -128
+small_int_max = 1024
+small_ints = [Integer(i) for i in range(small_int_min, small_int_max + 1)]
+
+# Integers in this range are preallocated, so the interpreter doesn't
+# allocate for counters and small arithmetic. Traces skip the cache: the JIT
+# keeps an Integer it allocated unboxed, and reading it out of the cache
+# would box it again.
+def make_int(int_val):
+    if not jit.we_are_jitted() and small_int_min <= int_val <= small_int_max:
+        return small_ints[int_val - small_int_min]
+    return Integer(int_val)
+
+
+# Integers that overflow a machine word become BigIntegers, and results that
+# fit one again go back to Integers, so each value has one representation
+class BigInteger(Object):
+    _immutable_ = True
+    _type = Integer._type
+
+    def __init__(self, big_val):
+        self._big_val = big_val
+
+    def to_string(self):
+        return self._big_val.str()
+
+    def type(self):
+        return self._type
+
+
+def make_big(big_val):
+    try:
+        return make_int(big_val.toint())
+    except OverflowError:
+        return BigInteger(big_val)
+
+
+def to_big(num):
+    if isinstance(num, BigInteger):
+        return num._big_val
+    return rbigint.fromint(num.int_val())
+
+
+def add(a, b):
+    if isinstance(a, Integer) and isinstance(b, Integer):
+        try:
+            return make_int(ovfcheck(a._int_val + b._int_val))
+        except OverflowError:
+            pass
+    return make_big(to_big(a).add(to_big(b)))
+
+
+def sub(a, b):
+    if isinstance(a, Integer) and isinstance(b, Integer):
+        try:
+            return make_int(ovfcheck(a._int_val - b._int_val))
+        except OverflowError:
+            pass
+    return make_big(to_big(a).sub(to_big(b)))
+
+
+def mul(a, b):
+    if isinstance(a, Integer) and isinstance(b, Integer):
+        try:
+            return make_int(ovfcheck(a._int_val * b._int_val))
+        except OverflowError:
+            pass
+    return make_big(to_big(a).mul(to_big(b)))
+
+
+def div(a, b):
+    if isinstance(a, Integer) and isinstance(b, Integer):
+        try:
+            return make_int(ovfcheck(a._int_val / b._int_val))
+        except OverflowError:
+            pass
+    return make_big(to_big(a).floordiv(to_big(b)))
+
+
+# Returns -1, 0 or 1 as a is less than, equal to or greater than b
+def compare(a, b):
+    if isinstance(a, Integer) and isinstance(b, Integer):
+        x = a._int_val
+        y = b._int_val
+    else:
+        x = to_big(a)
+        y = to_big(b)
+        if x.lt(y):
+            return -1
+        return 0 if x.eq(y) else 1
+    if x < y:
+        return -1
+    return 0 if x == y else 1
+
+
+# The variadic builtins walk their argument list once. add_all and mul_all
+# keep the running total a machine int until an argument is a BigInteger or a
+# step overflows, and only the result gets boxed; from there on the rest is
+# folded with add and mul.
+@jit.unroll_safe
+def add_all(acc, args):
+    while args is not nil:
+        num = args.car()
+        if not isinstance(num, Integer):
+            break
+        try:
+            acc = ovfcheck(acc + num._int_val)
+        except OverflowError:
+            break
+        args = args.cdr()
+    total = make_int(acc)
+    while args is not nil:
+        total = add(total, args.car())
+        args = args.cdr()
+    return total
+
+
+@jit.unroll_safe
+def mul_all(acc, args):
+    while args is not nil:
+        num = args.car()
+        if not isinstance(num, Integer):
+            break
+        try:
+            acc = ovfcheck(acc * num._int_val)
+        except OverflowError:
+            break
+        args = args.cdr()
+    total = make_int(acc)
+    while args is not nil:
+        total = mul(total, args.car())
+        args = args.cdr()
+    return total
+
+
+def equal(a, b):
+    if isinstance(a, Integer) and isinstance(b, Integer):
+        return a._int_val == b._int_val
+    elif isinstance(a, BigInteger) and isinstance(b, BigInteger):
+        return a._big_val.eq(b._big_val)
+    elif isinstance(a, String) and isinstance(b, String):
+        return a._length == b._length and a.str_val() == b.str_val()
+    return a is b
+
+
+# True if compare gives a result between lo and hi for every pair of
+# neighbouring arguments, so (< a b c) is lo = hi = -1
+@jit.unroll_safe
+def ordered(args, lo, hi):
+    if args is nil:
+        return true
+    prev = args.car()
+    args = args.cdr()
+    while args is not nil:
+        num = args.car()
+        c = compare(prev, num)
+        if c < lo or c > hi:
+            return false
+        prev = num
+        args = args.cdr()
+    return true
+
+
+# A String is either flat, with its characters in _str_val, or a rope: the
+# concatenation of _left and _right, whose characters are only put together
+# the first time they are needed. Concatenating is then O(1), and a text
+# built up piece by piece is copied once in the end, not once per piece.
 class String(Object):
     _immutable_ = True
     _type = Type("String")
 
-    def __init__(self, str_val):
+    def __init__(self, str_val, left=None, right=None):
         self._str_val = str_val
+        self._left = left
+        self._right = right
+        if left is None:
+            self._length = len(str_val)
+            self._flat = None
+        else:
+            self._length = left._length + right._length
+            self._flat = Flattened()
 
     def to_string(self):
-        return '"%s"' % self._str_val
+        return '"%s"' % self.str_val()
 
     def type(self):
         return self._type
 
+    def str_val(self):
+        if self._left is None:
+            return self._str_val
+        if self._flat.str_val is None:
+            builder = StringBuilder(self._length)
+            self.append_to(builder)
+            self._flat.str_val = builder.build()
+        return self._flat.str_val
+
+    # Walks the rope left to right without recursing, ropes built by
+    # appending in a loop are as deep as they are long
+    def append_to(self, builder):
+        todo = [self]
+        while len(todo) > 0:
+            s = todo.pop()
+            if s._left is None:
+                builder.append(s._str_val)
+            elif s._flat.str_val is not None:
+                builder.append(s._flat.str_val)
+            else:
+                todo.append(s._right)
+                todo.append(s._left)
+
+    def substring(self, start, end):
+        if start < 0 or end < start or end > self._length:
+            print("String index out of bounds: %d, %d" % (start, end))
+            raise IndexError
+        assert start >= 0 and end >= 0
+        return String(self.str_val()[start:end])
+
+
+# Where a rope keeps its characters once they have been put together
+class Flattened(object):
+    def __init__(self):
+        self.str_val = None
+
+
+empty_string = String("")
+
+# Concatenations shorter than this are copied into a flat string
+rope_min = 64
+
+def concat(a, b):
+    if a._length == 0:
+        return b
+    elif b._length == 0:
+        return a
+    elif a._length + b._length < rope_min:
+        return String(a.str_val() + b.str_val())
+    return String(None, a, b)
+
+
+# What str makes of an argument: strings as they are, nil as nothing
+def as_string(obj):
+    if isinstance(obj, String):
+        return obj
+    elif obj is nil:
+        return empty_string
+    return String(obj.to_string())
+
+
+# The global a Symbol names, None while it has none. Each Symbol owns its
+# cell, so reading a global never hashes anything.
+#
+# While the symbol has only been bound once, the value sits in _value, which
+# is quasi-immutable: a trace reading it from a constant cell gets a constant,
+# and setting it invalidates just the traces that read this cell. Binding the
+# symbol to another value marks the cell mutable, which invalidates them one
+# last time. From then on the value lives in _mutable_value, which traces read
+# like any other field, so a global that keeps changing doesn't keep throwing
+# traces away.
+class GlobalCell(object):
+    _immutable_fields_ = ["_value?", "_mutable?"]
+
+    def __init__(self):
+        self._value = None
+        self._mutable = False
+        self._mutable_value = None
+
+    def get(self):
+        if self._mutable:
+            return self._mutable_value
+        return self._value
+
+    def set(self, v):
+        if self._mutable:
+            self._mutable_value = v
+        else:
+            self._value = v
+
+    def is_mutable(self):
+        return self._mutable
+
+    def mark_mutable(self):
+        self._mutable_value = self._value
+        self._mutable = True
+        self._value = None
+
+
 class SymbolRegistry(object):
     def __init__(self):
         self._registry = {}
@@ -95,6 +387,7 @@ class Symbol(Object):
 
     def __init__(self, str_val):
         self._str_val = str_val
+        self._cell = GlobalCell()
 
     def to_string(self):
         return self._str_val
@@ -186,6 +479,343 @@ class Cons(Object):
 
         return acc
 
+
+# The first cell of a list the reader made, remembers the line the list
+# started on
+class SourceCons(Cons):
+    _immutable_ = True
+
+    def __init__(self, car, cdr, line):
+        self._car = car
+        self._cdr = cdr
+        self._line = line
+
+    def line(self):
+        return self._line
+
+
+def source_list(lst, line):
+    if len(lst) == 0:
+        return nil
+    acc = nil
+    i = len(lst) - 1
+    while i > 0:
+        acc = Cons(lst[i], acc)
+        i -= 1
+    return SourceCons(lst[0], acc, line)
+
+# An array-backed vector, what the reader makes of [...] outside of fn, let
+# and loop bindings. Vectors are never changed in place, conj copies.
+class Vector(Object):
+    _immutable_ = True
+    _immutable_fields_ = ["_items[*]"]
+    _type = Type("Vector")
+
+    def __init__(self, items):
+        self._items = items
+
+    def to_string(self):
+        return "[" + " ".join([itm.to_string() for itm in self._items]) + "]"
+
+    def type(self):
+        return self._type
+
+    def count(self):
+        return len(self._items)
+
+    def nth(self, index):
+        if index < 0 or index >= len(self._items):
+            print("Index out of bounds: %d" % index)
+            raise IndexError
+        return self._items[index]
+
+    def conj(self, args):
+        items = [itm for itm in self._items]
+        while args is not nil:
+            items.append(args.car())
+            args = args.cdr()
+        return Vector(fixed_list(items))
+
+    @staticmethod
+    def from_cons(lst):
+        items = []
+        while lst is not nil:
+            items.append(lst.car())
+            lst = lst.cdr()
+        return Vector(fixed_list(items))
+
+
+# Persistent hash map
+#
+# A hash array mapped trie: each level of BitmapNodes consumes 5 bits of the
+# key's hash, and a bitmap says which of the 32 possible children are present,
+# so the children array only holds those. assoc and dissoc copy the path from
+# the root down to the changed leaf and share everything else, so older
+# versions of a map stay valid. Keys whose hashes are equal all the way down
+# share a CollisionNode.
+#
+# Integers, BigIntegers and Strings are compared by value, every other key
+# (Symbols, which are interned, in particular) by identity.
+
+def key_hash(k):
+    if isinstance(k, Integer):
+        return k._int_val
+    elif isinstance(k, BigInteger):
+        return k._big_val.hash()
+    elif isinstance(k, String):
+        return objectmodel.compute_hash(k.str_val())
+    return objectmodel.compute_identity_hash(k)
+
+
+def bit_count(x):
+    x = x - ((x >> 1) & 0x55555555)
+    x = (x & 0x33333333) + ((x >> 2) & 0x33333333)
+    x = (x + (x >> 4)) & 0x0f0f0f0f
+    return ((x * 0x01010101) & 0xffffffff) >> 24
+
+
+def hash_bit(h, shift):
+    return 1 << ((h >> shift) & 31)
+
+
+class MapNode(object):
+    _immutable_ = True
+
+    # The value stored under key, or None
+    def find(self, shift, h, key):
+        return None
+
+    def assoc(self, shift, leaf):
+        return self
+
+    # The node without key, None once it is empty
+    def dissoc(self, shift, h, key):
+        return self
+
+    def collect(self, acc):
+        pass
+
+
+class HashedNode(MapNode):
+    _immutable_ = True
+    _hash = 0
+
+
+class Leaf(HashedNode):
+    _immutable_ = True
+
+    def __init__(self, h, key, val):
+        self._hash = h
+        self._key = key
+        self._val = val
+
+    def find(self, shift, h, key):
+        if h == self._hash and equal(key, self._key):
+            return self._val
+        return None
+
+    def assoc(self, shift, leaf):
+        if leaf._hash != self._hash:
+            return merge_nodes(shift, self, leaf)
+        if equal(leaf._key, self._key):
+            return leaf
+        return CollisionNode(self._hash, [self, leaf])
+
+    def dissoc(self, shift, h, key):
+        if h == self._hash and equal(key, self._key):
+            return None
+        return self
+
+    def collect(self, acc):
+        acc.append(self)
+
+
+class CollisionNode(HashedNode):
+    _immutable_ = True
+    _immutable_fields_ = ["_leaves[*]"]
+
+    def __init__(self, h, leaves):
+        self._hash = h
+        self._leaves = leaves
+
+    def index_of(self, key):
+        for i in range(len(self._leaves)):
+            if equal(key, self._leaves[i]._key):
+                return i
+        return -1
+
+    def find(self, shift, h, key):
+        if h != self._hash:
+            return None
+        i = self.index_of(key)
+        if i < 0:
+            return None
+        return self._leaves[i]._val
+
+    # The copies are sized up front, the leaves list has to stay fixed-size
+    def assoc(self, shift, leaf):
+        if leaf._hash != self._hash:
+            return merge_nodes(shift, self, leaf)
+        n = len(self._leaves)
+        i = self.index_of(leaf._key)
+        if i < 0:
+            i = n
+            leaves = [None] * (n + 1)
+        else:
+            leaves = [None] * n
+        for j in range(n):
+            leaves[j] = self._leaves[j]
+        leaves[i] = leaf
+        return CollisionNode(self._hash, leaves)
+
+    def dissoc(self, shift, h, key):
+        i = self.index_of(key) if h == self._hash else -1
+        if i < 0:
+            return self
+        leaves = [None] * (len(self._leaves) - 1)
+        for j in range(len(leaves)):
+            leaves[j] = self._leaves[j if j < i else j + 1]
+        if len(leaves) == 1:
+            return leaves[0]
+        return CollisionNode(self._hash, leaves)
+
+    def collect(self, acc):
+        for leaf in self._leaves:
+            acc.append(leaf)
+
+
+class BitmapNode(MapNode):
+    _immutable_ = True
+    _immutable_fields_ = ["_children[*]"]
+
+    def __init__(self, bitmap, children):
+        self._bitmap = bitmap
+        self._children = children
+
+    def position(self, bit):
+        return bit_count(self._bitmap & (bit - 1))
+
+    def find(self, shift, h, key):
+        bit = hash_bit(h, shift)
+        if self._bitmap & bit == 0:
+            return None
+        return self._children[self.position(bit)].find(shift + 5, h, key)
+
+    # Copies of children with room for one more child at pos, or with the
+    # one at pos left out. They are sized up front, children has to stay
+    # fixed-size.
+    def copied(self, insert_at=-1, remove_at=-1):
+        n = len(self._children)
+        if insert_at >= 0:
+            n += 1
+        elif remove_at >= 0:
+            n -= 1
+        children = [None] * n
+        j = 0
+        for i in range(len(self._children)):
+            if j == insert_at:
+                j += 1
+            if i != remove_at:
+                children[j] = self._children[i]
+                j += 1
+        return children
+
+    def assoc(self, shift, leaf):
+        bit = hash_bit(leaf._hash, shift)
+        pos = self.position(bit)
+        if self._bitmap & bit == 0:
+            children = self.copied(insert_at=pos)
+            children[pos] = leaf
+            return BitmapNode(self._bitmap | bit, children)
+        children = self.copied()
+        children[pos] = children[pos].assoc(shift + 5, leaf)
+        return BitmapNode(self._bitmap, children)
+
+    def dissoc(self, shift, h, key):
+        bit = hash_bit(h, shift)
+        if self._bitmap & bit == 0:
+            return self
+        pos = self.position(bit)
+        child = self._children[pos]
+        new_child = child.dissoc(shift + 5, h, key)
+        if new_child is child:
+            return self
+        if new_child is not None:
+            children = self.copied()
+            children[pos] = new_child
+            return BitmapNode(self._bitmap, children)
+        if self._bitmap == bit:
+            return None
+        return BitmapNode(self._bitmap & ~bit, self.copied(remove_at=pos))
+
+    def collect(self, acc):
+        for child in self._children:
+            child.collect(acc)
+
+
+# A node holding a and b, whose hashes differ
+def merge_nodes(shift, a, b):
+    bit_a = hash_bit(a._hash, shift)
+    bit_b = hash_bit(b._hash, shift)
+    if bit_a == bit_b:
+        return BitmapNode(bit_a, [merge_nodes(shift + 5, a, b)])
+    if bit_a < bit_b:
+        return BitmapNode(bit_a | bit_b, [a, b])
+    return BitmapNode(bit_a | bit_b, [b, a])
+
+
+class HashMap(Object):
+    _immutable_ = True
+    _type = Type("HashMap")
+
+    def __init__(self, root, count):
+        self._root = root
+        self._count = count
+
+    def to_string(self):
+        leaves = []
+        if self._root is not None:
+            self._root.collect(leaves)
+        return "{" + ", ".join([leaf._key.to_string() + " " + leaf._val.to_string() for leaf in leaves]) + "}"
+
+    def type(self):
+        return self._type
+
+    def count(self):
+        return self._count
+
+    def get(self, key):
+        if self._root is None:
+            return None
+        return self._root.find(0, key_hash(key), key)
+
+    def assoc(self, key, val):
+        h = key_hash(key)
+        leaf = Leaf(h, key, val)
+        if self._root is None:
+            return HashMap(leaf, 1)
+        count = self._count
+        if self._root.find(0, h, key) is None:
+            count += 1
+        return HashMap(self._root.assoc(0, leaf), count)
+
+    def dissoc(self, key):
+        if self.get(key) is None:
+            return self
+        return HashMap(self._root.dissoc(0, key_hash(key), key), self._count - 1)
+
+
+empty_map = HashMap(None, 0)
+
+
+# nil works as an empty map for get, assoc and dissoc
+def as_map(m):
+    if m is nil:
+        return empty_map
+    assert isinstance(m, HashMap)
+    return m
+
+
 class Fn(Object):
     _immutable_ = True
     _type = Type("Fn")
@@ -215,61 +845,65 @@ def defn(name):
 class Println(Fn):
     @jit.unroll_safe
     def invoke(self, args, stack):
-        strs = []
+        builder = StringBuilder()
         while args is not nil:
             itm = args.car()
             if isinstance(itm, String):
-                strs.append(itm._str_val)
+                itm.append_to(builder)
             else:
-                strs.append(itm.to_string())
+                builder.append(itm.to_string())
             args = args.cdr()
 
-        print("".join(strs))
+        print(builder.build())
         return nil, stack
 
 
 @defn("load-file")
 class LoadFile(Fn):
     def invoke(self, args, stack):
-        rdr = PushbackReader(FileReader(args.car()._str_val))
-        forms = read_all(rdr)
-        return nil, stack.push(EvalExpr(Env(), forms))
+        forms = load_forms(args.car().str_val())
+        if config.engine == "bytecode":
+            return eval_toplevel(compile_toplevel(forms)), stack
+        return nil, stack.push(EvalExpr(Env([]), compile_toplevel(forms)))
 
 
 @defn("<")
 class LessThan(Fn):
     def invoke(self, args, stack):
-        return true if args.car()._int_val < args.cdr().car()._int_val else false, stack
+        return ordered(args, -1, -1), stack
 
 
 @defn(">")
 class GreaterThan(Fn):
     def invoke(self, args, stack):
-        return true if args.car()._int_val > args.cdr().car()._int_val else false, stack
+        return ordered(args, 1, 1), stack
 
 
 @defn("<=")
 class LessThanOrEqual(Fn):
     def invoke(self, args, stack):
-        return true if args.car()._int_val <= args.cdr().car()._int_val else false, stack
+        return ordered(args, -1, 0), stack
 
 
 @defn(">=")
 class GreaterThanOrEqual(Fn):
     def invoke(self, args, stack):
-        return true if args.car()._int_val >= args.cdr().car()._int_val else false, stack
+        return ordered(args, 0, 1), stack
 
 
 @defn("=")
 class Equal(Fn):
+    @jit.unroll_safe
     def invoke(self, args, stack):
-        a = args.car()
-        b = args.cdr().car()
-
-        if isinstance(a, Integer) and isinstance(b, Integer):
-            return true if a._int_val == b._int_val else false, stack
-        else:
-            return true if a is b else false, stack
+        if args is nil:
+            return true, stack
+        first = args.car()
+        args = args.cdr()
+        while args is not nil:
+            if not equal(first, args.car()):
+                return false, stack
+            args = args.cdr()
+        return true, stack
 
 
 @defn("car")
@@ -304,35 +938,180 @@ class SymbolQ(Fn):
     def invoke(self, args, stack):
         return true if isinstance(args.car(), Symbol) else false, stack
 
+@defn("vector")
+class VectorFn(Fn):
+    def invoke(self, args, stack):
+        return Vector.from_cons(args), stack
+
+# nth and count also take lists, walking them, and count takes maps and
+# strings
+@defn("nth")
+class Nth(Fn):
+    @jit.unroll_safe
+    def invoke(self, args, stack):
+        coll = args.car()
+        index = args.cdr().car()
+        assert isinstance(index, Integer)
+        i = index.int_val()
+        if isinstance(coll, Vector):
+            return coll.nth(i), stack
+        while i > 0 and coll is not nil:
+            coll = coll.cdr()
+            i -= 1
+        if i != 0 or coll is nil:
+            print("Index out of bounds: %d" % index.int_val())
+            raise IndexError
+        return coll.car(), stack
+
+@defn("count")
+class Count(Fn):
+    def invoke(self, args, stack):
+        coll = args.car()
+        if isinstance(coll, Vector):
+            return make_int(coll.count()), stack
+        elif isinstance(coll, HashMap):
+            return make_int(coll.count()), stack
+        elif isinstance(coll, String):
+            return make_int(coll._length), stack
+        return make_int(list_length(coll)), stack
+
+# Adds to the end of a vector and to the front of a list
+@defn("conj")
+class Conj(Fn):
+    @jit.unroll_safe
+    def invoke(self, args, stack):
+        coll = args.car()
+        args = args.cdr()
+        if isinstance(coll, Vector):
+            return coll.conj(args), stack
+        while args is not nil:
+            coll = Cons(args.car(), coll)
+            args = args.cdr()
+        return coll, stack
+
+@defn("hash-map")
+class HashMapFn(Fn):
+    def invoke(self, args, stack):
+        m = empty_map
+        while args is not nil:
+            m = m.assoc(args.car(), args.cdr().car())
+            args = args.cdr().cdr()
+        return m, stack
+
+# (get m k) is nil if m has no k, (get m k default) is default then
+@defn("get")
+class Get(Fn):
+    def invoke(self, args, stack):
+        val = as_map(args.car()).get(args.cdr().car())
+        if val is not None:
+            return val, stack
+        default = args.cdr().cdr()
+        if default is nil:
+            return nil, stack
+        return default.car(), stack
+
+@defn("assoc")
+class Assoc(Fn):
+    def invoke(self, args, stack):
+        m = as_map(args.car())
+        args = args.cdr()
+        while args is not nil:
+            m = m.assoc(args.car(), args.cdr().car())
+            args = args.cdr().cdr()
+        return m, stack
+
+@defn("dissoc")
+class Dissoc(Fn):
+    def invoke(self, args, stack):
+        m = as_map(args.car())
+        args = args.cdr()
+        while args is not nil:
+            m = m.dissoc(args.car())
+            args = args.cdr()
+        return m, stack
+
+@defn("str")
+class Str(Fn):
+    def invoke(self, args, stack):
+        acc = empty_string
+        while args is not nil:
+            acc = concat(acc, as_string(args.car()))
+            args = args.cdr()
+        return acc, stack
+
+@defn("str-concat")
+class StrConcat(Fn):
+    def invoke(self, args, stack):
+        acc = empty_string
+        while args is not nil:
+            s = args.car()
+            assert isinstance(s, String)
+            acc = concat(acc, s)
+            args = args.cdr()
+        return acc, stack
+
+# (subs s start) or (subs s start end), end exclusive
+@defn("subs")
+class Subs(Fn):
+    def invoke(self, args, stack):
+        s = args.car()
+        start = args.cdr().car()
+        rest = args.cdr().cdr()
+        assert isinstance(s, String)
+        assert isinstance(start, Integer)
+        end = s._length
+        if rest is not nil:
+            end_val = rest.car()
+            assert isinstance(end_val, Integer)
+            end = end_val.int_val()
+        return s.substring(start.int_val(), end), stack
+
+zero = make_int(0)
+one = make_int(1)
+
 @defn("inc")
 class Inc(Fn):
     def invoke(self, args, stack):
-        return Integer(args.car().int_val() + 1), stack
+        return add(args.car(), one), stack
 
 @defn("dec")
 class Inc(Fn):
     def invoke(self, args, stack):
-        return Integer(args.car().int_val() - 1), stack
+        return sub(args.car(), one), stack
 
 @defn("+")
 class Add(Fn):
     def invoke(self, args, stack):
-        return Integer(args.car().int_val() + args.cdr().car().int_val()), stack
+        return add_all(0, args), stack
 
+# (- x) negates x, (- x y z) is x minus the sum of the rest
 @defn("-")
 class Sub(Fn):
     def invoke(self, args, stack):
-        return Integer(args.car().int_val() - args.cdr().car().int_val()), stack
+        rest = args.cdr()
+        if rest is nil:
+            return sub(zero, args.car()), stack
+        return sub(args.car(), add_all(0, rest)), stack
 
 @defn("*")
 class Mul(Fn):
     def invoke(self, args, stack):
-        return Integer(args.car().int_val() * args.cdr().car().int_val()), stack
+        return mul_all(1, args), stack
 
 @defn("/")
 class Div(Fn):
+    @jit.unroll_safe
     def invoke(self, args, stack):
-        return Integer(args.car().int_val() / args.cdr().car().int_val()), stack
+        acc = args.car()
+        args = args.cdr()
+        # A single argument gets its reciprocal, 1 divided by it, like - of
+        # a single argument negates it
+        if args is nil:
+            return div(one, acc), stack
+        while args is not nil:
+            acc = div(acc, args.car())
+            args = args.cdr()
+        return acc, stack
 
 @defn("vararg")
 class VarArg(Fn):
@@ -355,8 +1134,12 @@ class Die(Fn):
 @defn("read-file")
 class ReadFile(Fn):
     def invoke(self, args, stack):
-        rdr = PushbackReader(FileReader(args.car()._str_val))
-        return read_all(rdr), stack
+        return load_forms(args.car().str_val()), stack
+
+@defn("parse-cache-stats")
+class ParseCacheStats(Fn):
+    def invoke(self, args, stack):
+        return Cons.from_list([make_int(parsed_files.hits), make_int(parsed_files.misses)]), stack
 
 
 class VarArgLambda(Fn):
@@ -374,23 +1157,109 @@ class VarArgLambda(Fn):
 # Reader Begins
 
 class Reader(object):
+    # The line the next character is on, counted by the reader functions as
+    # they skip newlines
+    def __init__(self):
+        self.line = 1
+
     def read(self):
         return -1
 
+    def unread(self, ch):
+        pass
+
+    # Readers backed by an in-memory view of the whole file return their
+    # current index, so tokens can be sliced out instead of built per char
+    def mark(self):
+        return -1
+
+    def slice(self, start, end):
+        return ""
+
+    def close(self):
+        pass
+
 
 class FileReader(Reader):
+    block_size = 64 * 1024
+
     def __init__(self, file_name):
+        Reader.__init__(self)
         self._file = streamio.open_file_as_stream(file_name)
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            raise EOFError()
+        self._buf = self._file.read(self.block_size)
+        self._pos = 0
+        if len(self._buf) == 0:
+            self.close()
+            raise EOFError()
+
+    def read(self):
+        if self._pos >= len(self._buf):
+            self._fill()
+        ch = self._buf[self._pos]
+        self._pos += 1
+        return ord(ch)
+
+    def close(self):
+        if not self._eof:
+            self._eof = True
+            self._file.close()
+
+
+class MappedFileReader(Reader):
+    def __init__(self, file_name):
+        Reader.__init__(self)
+        fd = os.open(file_name, os.O_RDONLY, 0)
+        try:
+            self._map = rmmap.mmap(fd, 0, access=rmmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        self._size = self._map.len()
+        self._pos = 0
+        self._closed = False
 
     def read(self):
-        ch = self._file.read(1)
-        if len(ch) == 0:
+        if self._pos >= self._size:
             raise EOFError()
-        return ord(ch[0])
+        ch = self._map.getitem(self._pos)
+        self._pos += 1
+        return ord(ch)
+
+    def unread(self, ch):
+        self._pos -= 1
+
+    def mark(self):
+        return self._pos
+
+    def slice(self, start, end):
+        return self._map.getslice(start, end - start)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._map.close()
+
+
+# Files at least this big are parsed straight out of a memory mapping. An
+# empty file can't be mapped, so it's always read as a stream.
+mmap_threshold = 1024 * 1024
+
+def open_reader(file_name):
+    size = os.stat(file_name).st_size
+    if size > 0 and size >= mmap_threshold:
+        return MappedFileReader(file_name)
+    return PushbackReader(FileReader(file_name))
 
 
 class PushbackReader(Reader):
     def __init__(self, inner):
+        Reader.__init__(self)
         self._inner = inner
         self._has_unread = False
         self._unread_char = 0
@@ -407,42 +1276,58 @@ class PushbackReader(Reader):
         self._has_unread = True
         self._unread_char = ch
 
+    def close(self):
+        self._inner.close()
+
 
 def list_reader(terminator):
     def list_reader_inner(rdr):
-        ch = rdr.read()
-
-        while ch in whitespace:
-            ch = rdr.read()
+        line = rdr.line
+        ch = skip_whitespace(rdr, rdr.read())
 
         acc = []
         while True:
             if ch == terminator:
-                return Cons.from_list(acc)
+                return source_list(acc, line)
 
-            rdr.unread(ch)
-
-            acc.append(read(rdr))
+            # The bindings of fn, let and loop stay lists
+            if ch == ord("[") and len(acc) == 1 and acc[0] in binding_forms:
+                acc.append(binding_reader(rdr))
+            else:
+                rdr.unread(ch)
+                acc.append(read(rdr))
 
-            ch = rdr.read()
+            ch = skip_whitespace(rdr, rdr.read())
 
 
     return list_reader_inner
 
+binding_reader = list_reader(ord("]"))
+
+def vector_reader(rdr):
+    return Vector.from_cons(binding_reader(rdr))
+
 def string_reader(rdr):
+    start = rdr.mark()
     acc = []
     ch = rdr.read()
     while ch != ord("\""):
-        acc.append(chr(ch))
+        if ch == newline:
+            rdr.line += 1
+        if start < 0:
+            acc.append(chr(ch))
         ch = rdr.read()
 
-    return String("".join(acc))
+    if start < 0:
+        return String("".join(acc))
+    return String(rdr.slice(start, rdr.mark() - 1))
 
 def comment_reader(rdr):
     ch = rdr.read()
-    while ch != ord("\n"):
+    while ch != newline:
         ch = rdr.read()
 
+    rdr.line += 1
     return None
 
 quote_sym = Symbol.intern("quote")
@@ -453,38 +1338,79 @@ fn_sym = Symbol.intern("fn")
 cond_sym = Symbol.intern("cond")
 resolve_sym = Symbol.intern("resolve")
 let_sym = Symbol.intern("let")
+loop_sym = Symbol.intern("loop")
+recur_sym = Symbol.intern("recur")
 self_sym = Symbol.intern("__self__")
+vector_sym = Symbol.intern("vector")
+
+binding_forms = {fn_sym: True, let_sym: True, loop_sym: True}
 
 def quote_reader(rdr):
     return Cons.from_list([quote_sym, read(rdr)])
 
 
-def str_to_ints(str):
-    return list(map(ord, str))
-
-whitespace = list(map(ord, "\n\t \r,"))
-
 macros = {ord("("): list_reader(ord(")")),
-          ord("["): list_reader(ord("]")),
+          ord("["): vector_reader,
           ord("\""): string_reader,
           ord(";"): comment_reader,
           ord("'"): quote_reader}
 
-alphanums = str_to_ints("1234567890abcdefghijklmnopqrstuvwxyz_!-+*/<>=?")
+# Every character the reader sees is classified by indexing these 256 entry
+# tables instead of scanning lists of characters
+WHITESPACE = 1
+SYMBOL = 2
+DIGIT = 4
+MACRO = 8
+
+char_classes = [0] * 256
+macro_table = [None] * 256
+
+def add_char_class(chars, flag):
+    for ch in chars:
+        char_classes[ord(ch)] |= flag
+
+add_char_class("\n\t \r,", WHITESPACE)
+add_char_class("1234567890abcdefghijklmnopqrstuvwxyz_!-+*/<>=?", SYMBOL)
+add_char_class("1234567890", DIGIT)
 
-nums = str_to_ints("1234567890")
+for ch, macro in macros.items():
+    char_classes[ch] |= MACRO
+    macro_table[ch] = macro
+
+def is_whitespace(ch):
+    return char_classes[ch] & WHITESPACE != 0
+
+newline = ord("\n")
+
+# Returns the first character from ch on that isn't whitespace
+def skip_whitespace(rdr, ch):
+    while is_whitespace(ch):
+        if ch == newline:
+            rdr.line += 1
+        ch = rdr.read()
+    return ch
+
+def is_symbol_char(ch):
+    return char_classes[ch] & SYMBOL != 0
+
+def is_digit(ch):
+    return char_classes[ch] & DIGIT != 0
 
 def symbol_reader(rdr, start):
+    begin = rdr.mark() - 1
     acc = []
     ch = start
 
-    while ch in alphanums:
-        acc.append(chr(ch))
+    while is_symbol_char(ch):
+        if begin < 0:
+            acc.append(chr(ch))
         ch = rdr.read()
 
     rdr.unread(ch)
 
-    return interpret_symbol("".join(acc))
+    if begin < 0:
+        return interpret_symbol("".join(acc))
+    return interpret_symbol(rdr.slice(begin, rdr.mark()))
 
 direct_mappings = {"true": true,
                    "false": false,
@@ -495,21 +1421,21 @@ def interpret_symbol(sym):
     if direct is not None:
         return direct
 
-    if ord(sym[0]) in nums or (sym[0] == "-" and len(sym) > 1 and ord(sym[1]) in nums):
-        return Integer(int(sym))
+    if is_digit(ord(sym[0])) or (sym[0] == "-" and len(sym) > 1 and is_digit(ord(sym[1]))):
+        digits = len(sym) - 1 if sym[0] == "-" else len(sym)
+        if digits < 18:
+            return make_int(int(sym))
+        return make_big(rbigint.fromdecimalstr(sym))
     return Symbol.intern(sym)
 
 
 def read(rdr):
 
     while True:
-        ch = rdr.read()
-        while ch in whitespace:
-            ch = rdr.read()
+        ch = skip_whitespace(rdr, rdr.read())
 
-        macro = macros.get(ch, None)
-        if macro is not None:
-            result = macro(rdr)
+        if char_classes[ch] & MACRO != 0:
+            result = macro_table[ch](rdr)
 
             if result is None:
                 continue
@@ -525,8 +1451,371 @@ def read_all(rdr):
             acc.append(read(rdr))
         except EOFError:
             return Cons.from_list(acc)
+
+# Closes the reader also when parsing fails, so a syntax error doesn't leak
+# the file or its mapping
+def read_all_and_close(rdr):
+    try:
+        return read_all(rdr)
+    finally:
+        rdr.close()
 # End of Reader Code
 
+# Parsed form cache
+#
+# load_forms keeps a binary dump of each file's parsed forms next to the source
+# (foo.clj -> foo.clj.cache), stamped with the source size and mtime. As long
+# as those match, loading the file decodes the dump instead of running read_all.
+#
+# Layout: magic, source size, source mtime (ms), then one tagged form. Varints
+# are little endian base 128. Symbols are written by name the first time they
+# appear and by index after that. BigIntegers are written in decimal.
+# Vectors are written like proper lists, under their own tag, and so are lists
+# the reader made, with the line they started on in front.
+
+cache_magic = "LIXC\x03"
+cache_suffix = ".cache"
+
+
+class CacheError(Exception):
+    pass
+
+
+class FormEncoder(object):
+    def __init__(self, stream):
+        self._stream = stream
+        self._out = []
+        self._symbols = {}
+
+    def flush(self):
+        self._stream.write("".join(self._out))
+        self._out = []
+
+    def write_varint(self, v):
+        assert v >= 0
+        while v >= 0x80:
+            self._out.append(chr((v & 0x7f) | 0x80))
+            v >>= 7
+        self._out.append(chr(v))
+
+    def write_bytes(self, s):
+        self._out.append(s)
+
+    def write_str(self, s):
+        self.write_varint(len(s))
+        self.write_bytes(s)
+
+    def write_form(self, form):
+        if len(self._out) >= 4096:
+            self.flush()
+
+        if form is nil:
+            self._out.append("n")
+        elif form is true:
+            self._out.append("t")
+        elif form is false:
+            self._out.append("f")
+        elif isinstance(form, Integer):
+            if form._int_val >= 0:
+                self._out.append("i")
+                self.write_varint(form._int_val)
+            else:
+                self._out.append("j")
+                self.write_varint(-(form._int_val + 1))
+        elif isinstance(form, BigInteger):
+            self._out.append("b")
+            self.write_str(form._big_val.str())
+        elif isinstance(form, String):
+            self._out.append("s")
+            self.write_str(form.str_val())
+        elif isinstance(form, Symbol):
+            idx = self._symbols.get(form, -1)
+            if idx < 0:
+                self._symbols[form] = len(self._symbols)
+                self._out.append("S")
+                self.write_str(form._str_val)
+            else:
+                self._out.append("y")
+                self.write_varint(idx)
+        elif isinstance(form, Vector):
+            self._out.append("v")
+            self.write_varint(len(form._items))
+            for itm in form._items:
+                self.write_form(itm)
+        elif isinstance(form, Cons):
+            items = []
+            c = form
+            while isinstance(c, Cons):
+                items.append(c.car())
+                c = c.cdr()
+            if c is nil:
+                if isinstance(form, SourceCons):
+                    self._out.append("L")
+                    self.write_varint(form.line())
+                else:
+                    self._out.append("l")
+                self.write_varint(len(items))
+                for itm in items:
+                    self.write_form(itm)
+            else:
+                self._out.append("c")
+                self.write_form(form.car())
+                self.write_form(form.cdr())
+        else:
+            raise CacheError()
+
+
+class FormDecoder(object):
+    def __init__(self, data):
+        self._data = data
+        self._size = len(data)
+        self._pos = 0
+        self._symbols = []
+
+    def char_at(self, pos):
+        return self._data[pos]
+
+    def slice(self, start, end):
+        return self._data[start:end]
+
+    def read_byte(self):
+        if self._pos >= self._size:
+            raise CacheError()
+        ch = self.char_at(self._pos)
+        self._pos += 1
+        return ch
+
+    def read_varint(self):
+        v = 0
+        shift = 0
+        while True:
+            b = ord(self.read_byte())
+            v |= (b & 0x7f) << shift
+            if b < 0x80:
+                return v
+            shift += 7
+            # More continuation bytes than a machine word holds
+            if shift > 63:
+                raise CacheError()
+
+    def read_str(self):
+        length = self.read_varint()
+        start = self._pos
+        end = start + length
+        if end > self._size:
+            raise CacheError()
+        assert start >= 0 and end >= 0
+        self._pos = end
+        return self.slice(start, end)
+
+    def expect(self, s):
+        for ch in s:
+            if self.read_byte() != ch:
+                raise CacheError()
+
+    def at_end(self):
+        return self._pos == self._size
+
+    def read_form(self):
+        tag = self.read_byte()
+        if tag == "n":
+            return nil
+        elif tag == "t":
+            return true
+        elif tag == "f":
+            return false
+        elif tag == "i":
+            return make_int(self.read_varint())
+        elif tag == "j":
+            return make_int(-self.read_varint() - 1)
+        elif tag == "b":
+            return make_big(rbigint.fromdecimalstr(self.read_str()))
+        elif tag == "s":
+            return String(self.read_str())
+        elif tag == "S":
+            sym = Symbol.intern(self.read_str())
+            self._symbols.append(sym)
+            return sym
+        elif tag == "y":
+            idx = self.read_varint()
+            if idx >= len(self._symbols):
+                raise CacheError()
+            return self._symbols[idx]
+        elif tag == "l":
+            count = self.read_varint()
+            items = []
+            for i in range(count):
+                items.append(self.read_form())
+            return Cons.from_list(items)
+        elif tag == "L":
+            line = self.read_varint()
+            count = self.read_varint()
+            if count == 0:
+                raise CacheError()
+            items = []
+            for i in range(count):
+                items.append(self.read_form())
+            return source_list(items, line)
+        elif tag == "v":
+            count = self.read_varint()
+            items = [None] * count
+            for i in range(count):
+                items[i] = self.read_form()
+            return Vector(items)
+        elif tag == "c":
+            car = self.read_form()
+            return Cons(car, self.read_form())
+        raise CacheError()
+
+
+# Decodes straight out of a memory mapping of the cache, so a big cache is
+# never copied into a string first. Every string it returns is a copy, so
+# the forms outlive the mapping.
+class MappedFormDecoder(FormDecoder):
+    def __init__(self, mapping):
+        FormDecoder.__init__(self, "")
+        self._map = mapping
+        self._size = mapping.len()
+
+    def char_at(self, pos):
+        return self._map.getitem(pos)
+
+    def slice(self, start, end):
+        return self._map.getslice(start, end - start)
+
+
+# Caches as big as mmap_threshold are mapped like their sources, smaller
+# ones are read into a string
+def read_cached_forms(cache_name, size, mtime):
+    try:
+        cache_size = os.stat(cache_name).st_size
+        if cache_size > 0 and cache_size >= mmap_threshold:
+            return read_mapped_cache(cache_name, size, mtime)
+        f = streamio.open_file_as_stream(cache_name)
+        try:
+            data = f.readall()
+        finally:
+            f.close()
+    except (OSError, streamio.StreamError, rmmap.RMMapError):
+        return None
+    return decode_cache(FormDecoder(data), size, mtime)
+
+
+def read_mapped_cache(cache_name, size, mtime):
+    fd = os.open(cache_name, os.O_RDONLY, 0)
+    try:
+        mapping = rmmap.mmap(fd, 0, access=rmmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+    try:
+        return decode_cache(MappedFormDecoder(mapping), size, mtime)
+    finally:
+        mapping.close()
+
+
+def decode_cache(decoder, size, mtime):
+    try:
+        decoder.expect(cache_magic)
+        if decoder.read_varint() != size or decoder.read_varint() != mtime:
+            return None
+        forms = decoder.read_form()
+        if not decoder.at_end():
+            return None
+        return forms
+    except CacheError:
+        return None
+
+
+def write_cached_forms(cache_name, size, mtime, forms):
+    # Written under a temporary name and renamed so a concurrent reader
+    # never sees half a file
+    tmp_name = cache_name + ".tmp"
+    try:
+        f = streamio.open_file_as_stream(tmp_name, "w")
+        try:
+            encoder = FormEncoder(f)
+            encoder.write_bytes(cache_magic)
+            encoder.write_varint(size)
+            encoder.write_varint(mtime)
+            encoder.write_form(forms)
+            encoder.flush()
+        finally:
+            f.close()
+        os.rename(tmp_name, cache_name)
+    except (CacheError, OSError, streamio.StreamError):
+        remove_file(tmp_name)
+
+
+# Removes a file that may not exist or may not be removable
+def remove_file(file_name):
+    try:
+        os.unlink(file_name)
+    except OSError:
+        pass
+
+
+class ParsedFile(object):
+    def __init__(self, size, mtime, forms):
+        self.size = size
+        self.mtime = mtime
+        self.forms = forms
+
+
+class ParsedFiles(object):
+    # In-process table of parsed files, so loading the same file again in
+    # the same run skips the disk entirely. Entries are dropped once the file
+    # changes, or least recently used first once there are `capacity` of them.
+
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._entries = {}
+        self._order = []
+        self.hits = 0
+        self.misses = 0
+
+    def _touch(self, file_name):
+        if file_name in self._order:
+            self._order.remove(file_name)
+        self._order.append(file_name)
+
+    def get(self, file_name, size, mtime):
+        entry = self._entries.get(file_name, None)
+        if entry is not None and entry.size == size and entry.mtime == mtime:
+            self.hits += 1
+            self._touch(file_name)
+            return entry.forms
+
+        self.misses += 1
+        return None
+
+    def put(self, file_name, size, mtime, forms):
+        self._entries[file_name] = ParsedFile(size, mtime, forms)
+        self._touch(file_name)
+        while len(self._order) > self._capacity:
+            del self._entries[self._order.pop(0)]
+
+
+parsed_files = ParsedFiles(32)
+
+
+def load_forms(file_name):
+    st = os.stat(file_name)
+    size = st.st_size
+    mtime = int(st.st_mtime * 1000)
+
+    forms = parsed_files.get(file_name, size, mtime)
+    if forms is not None:
+        return forms
+
+    cache_name = file_name + cache_suffix
+    forms = read_cached_forms(cache_name, size, mtime)
+    if forms is None:
+        forms = read_all_and_close(open_reader(file_name))
+        write_cached_forms(cache_name, size, mtime, forms)
+
+    parsed_files.put(file_name, size, mtime, forms)
+    return forms
+
 # Start of Interpreter
 
 class Stack(object):
@@ -566,88 +1855,68 @@ class EvalExpr(Continuation):
         self._expr = jit.promote(expr)
 
     def call_continuation(self, val, stack):
-        return eval_one(self._env, jit.promote(self._expr), stack)
+        return jit.promote(self._expr).eval(self._env, stack)
 
     def expr(self):
         return self._expr
 
 class ApplyContinuation(Continuation):
     _immutable_ = True
-    def __init__(self, env, f, args):
+    def __init__(self, env, f, vals):
         self._env = env
         self._f = f
-        self._args = args
+        self._vals = vals
 
     def call_continuation(self, val, stack):
-        return self._f.invoke(self._args, stack)
-
-    def expr(self):
-        return self._f
-
-    def can_enter_jit(self):
-        self_f = self._env.lookup(self_sym)
-        if isinstance(self_f, Lambda) and isinstance(self._f, Lambda):
-            return self_f._body is self._f._body
-        return False
+        return self._f.invoke_vals(self._vals, stack)
 
 class EvalApply(Continuation):
     _immutable_ = True
 
-    def __init__(self, env, exprs, expr_count=1):
+    # Receives the value of the fn (index 0) or of argument index - 1 of a
+    # Call node, and stores it into slot index of the call's argument buffer
+    def __init__(self, env, node, index, vals):
         self._env = env
-        self._exprs = exprs
-        self._expr_count = expr_count
+        self._node = node
+        self._index = index
+        self._vals = vals
 
-    @jit.unroll_safe
     def call_continuation(self, val, stack):
-        if self._exprs is nil:
-            if self._expr_count == 1:
-                f = val
-                args = nil
-            else:
-                args = Cons(val)
-
-                for x in range(self._expr_count - 2):
-                    k, stack = stack.pop()
-                    args = Cons(k.val(), args)
-                k, stack = stack.pop()
-                f = k.val()
-            return nil, stack.push(ApplyContinuation(self._env, f, args))
+        node = jit.promote(self._node)
+        index = jit.promote(self._index)
+        vals = self._vals
+        vals[index] = val
+        if index == len(node._args):
+            return nil, stack.push(ApplyContinuation(self._env, vals[0], vals))
 
         else:
-            stack = stack.push(Val(val)) \
-                         .push(EvalApply(self._env, self._exprs.cdr(), self._expr_count + 1)) \
-                         .push(EvalExpr(self._env, self._exprs.car()))
+            stack = stack.push(EvalApply(self._env, node, index + 1, vals)) \
+                         .push(EvalExpr(self._env, node._args[index]))
             return nil, stack
 
     def expr(self):
-        return self._exprs
-
-class Val(Continuation):
-    _immutable_ = True
-
-    def __init__(self, val):
-        self._val = val
-
-    def val(self):
-        return self._val
+        return self._node
 
 class DoContinuation(Continuation):
     _immutable_ = True
 
-    def __init__(self, env, exprs):
+    # Evaluates exprs[index] of a Do node, and the rest of the body after it
+    def __init__(self, env, node, index):
         self._env = env
-        self._args = exprs
+        self._node = node
+        self._index = index
 
     def call_continuation(self, val, stack):
-        if self._args.cdr() is nil:
-            return nil, stack.push(EvalExpr(self._env, self._args.car()))
+        node = jit.promote(self._node)
+        index = jit.promote(self._index)
+        if index == len(node._exprs) - 1:
+            return nil, stack.push(EvalExpr(self._env, node._exprs[index]))
         else:
-            return nil, stack.push(DoContinuation(self._env, self._args.cdr())) \
-                             .push(EvalExpr(self._env, self._args.car()))
+            return nil, stack.push(DoContinuation(self._env, node, index + 1)) \
+                             .push(EvalExpr(self._env, node._exprs[index]))
 
     def expr(self):
-        return self._args
+        return self._node
 
 class DefContinuation(Continuation):
     _immutable_ = True
@@ -663,58 +1932,131 @@ class DefContinuation(Continuation):
 class IfContinuation(Continuation):
     _immutable_ = True
 
-    def __init__(self, env, then_expr, else_expr):
+    def __init__(self, env, node):
         self._env = env
-        self._then_expr = then_expr
-        self._else_expr = else_expr
+        self._node = node
 
     def call_continuation(self, val, stack):
+        node = jit.promote(self._node)
         if val is nil or val is false:
-            return nil, stack.push(EvalExpr(self._env, self._else_expr))
+            return nil, stack.push(EvalExpr(self._env, node._else))
         else:
-            return nil, stack.push(EvalExpr(self._env, self._then_expr))
+            return nil, stack.push(EvalExpr(self._env, node._then))
 
 
 class CondContinuation(Continuation):
     _immutable_ = True
 
-    def __init__(self, env, exprs):
+    # Receives the value of the test of the clause starting at index
+    def __init__(self, env, node, index):
         self._env = env
-        self._exprs = exprs
+        self._node = node
+        self._index = index
 
     def call_continuation(self, val, stack):
+        node = jit.promote(self._node)
+        index = jit.promote(self._index)
         if val is not nil and val is not false:
-            return nil, stack.push(EvalExpr(self._env, self._exprs.car()))
-        elif self._exprs.cdr() is nil:
+            return nil, stack.push(EvalExpr(self._env, node._clauses[index + 1]))
+        elif index + 2 >= len(node._clauses):
             return nil, stack
         else:
-            return nil, stack.push(CondContinuation(self._env, self._exprs.cdr().cdr())) \
-                             .push(EvalExpr(self._env, self._exprs.cdr().car()))
+            return nil, stack.push(CondContinuation(self._env, node, index + 2)) \
+                             .push(EvalExpr(self._env, node._clauses[index + 2]))
 
     def expr(self):
-        return self._exprs
+        return self._node
 
 
 class LetContinuation(Continuation):
     _immutable_ = True
 
-    def __init__(self, env, sym, bind, body):
-        self._sym = sym
+    # env is the let's own frame, the evaluated binding goes into slot index
+    def __init__(self, env, node, index):
         self._env = env
-        self._bind = bind
-        self._body = body
+        self._node = node
+        self._index = index
+
+    def call_continuation(self, val, stack):
+        node = jit.promote(self._node)
+        index = jit.promote(self._index)
+        self._env.set(index, val)
+        if index == len(node._inits) - 1:
+            return nil, stack.push(EvalExpr(self._env, node._body))
+        else:
+            return nil, stack.push(LetContinuation(self._env, node, index + 1)) \
+                             .push(EvalExpr(self._env, node._inits[index + 1]))
+
+    def expr(self):
+        return self._node
+
+
+
+class RecurContinuation(Continuation):
+    _immutable_ = True
+
+    # Receives the value of argument index of a Recur node into vals, which
+    # becomes the loop's next frame
+    def __init__(self, env, node, index, vals):
+        self._env = env
+        self._node = node
+        self._index = index
+        self._vals = vals
 
     def call_continuation(self, val, stack):
-        new_env = self._env.bind(self._sym, val)
-        if self._bind is nil:
-            return nil, stack.push(DoContinuation(new_env, self._body))
+        node = jit.promote(self._node)
+        index = jit.promote(self._index)
+        vals = self._vals
+        vals[index] = val
+        if index == len(node._args) - 1:
+            return nil, stack.push(LoopContinuation(node.loop_env(self._env, vals), node._loop))
         else:
-            return nil, stack.push(LetContinuation(new_env, self._bind.car(), self._bind.cdr().cdr(), self._body)) \
-                             .push(EvalExpr(new_env, self._bind.cdr().car()))
+            return nil, stack.push(RecurContinuation(self._env, node, index + 1, vals)) \
+                             .push(EvalExpr(self._env, node._args[index + 1]))
+
+    def expr(self):
+        return self._node
+
+
+# Starts another iteration of a loop. This is the loop header the JIT traces
+# from, the same Loop node is reached on every iteration.
+class LoopContinuation(Continuation):
+    _immutable_ = True
+
+    def __init__(self, env, node):
+        self._env = env
+        self._node = node
+
+    def call_continuation(self, val, stack):
+        node = jit.promote(self._node)
+        return nil, stack.push(EvalExpr(self._env, node._body))
+
+    def expr(self):
+        return self._node
+
+    def can_enter_jit(self):
+        return True
+
+
+# Starts evaluating the body of a Lambda. Every call goes through here, so
+# this is the function entry the JIT counts and traces from. The green key is
+# the body rather than the Lambda, so all closures made by one fn share it,
+# and mutually recursive fns each get their own entry.
+class EnterContinuation(Continuation):
+    _immutable_ = True
+
+    def __init__(self, env, body):
+        self._env = env
+        self._body = body
+
+    def call_continuation(self, val, stack):
+        return jit.promote(self._body).eval(self._env, stack)
 
     def expr(self):
-        return self._bind
+        return self._body
 
+    def can_enter_jit(self):
+        return True
 
 
 class ResolveContinuation(Continuation):
@@ -729,140 +2071,575 @@ class ResolveContinuation(Continuation):
 
 class Lambda(Fn):
     _immutable_ = True
-    def __init__(self, env, arg_list, body):
-        self._env = env.bind(self_sym, self)
-        self._arg_list = arg_list
+    def __init__(self, env, arity, body):
+        self._env = env
+        self._arity = arity
         self._body = body
 
     def to_string(self):
         return "Lambda"
 
+    # One frame per call: slot 0 holds __self__, the arguments follow it.
+    # Missing arguments are nil and extra ones are dropped.
     @jit.unroll_safe
-    def invoke(self, args, stack):
-        new_env = jit.promote(self._env)
-        arg_list = self._arg_list
-        while args is not nil:
-            new_env = new_env.bind(arg_list.car(), args.car())
-            arg_list = arg_list.cdr()
+    def make_env(self, args):
+        arity = jit.promote(self._arity)
+        vals = [nil] * (arity + 1)
+        vals[0] = self
+        i = 1
+        while args is not nil and i <= arity:
+            vals[i] = args.car()
             args = args.cdr()
+            i += 1
+
+        return Env(vals, jit.promote(self._env))
+
+    def invoke(self, args, stack):
+        return nil, stack.push(EnterContinuation(self.make_env(args), self._body))
+
+    # A call with exactly arity arguments leaves its buffer laid out like the
+    # frame, with the fn itself in slot 0, so it becomes the frame as is
+    def invoke_vals(self, vals, stack):
+        if len(vals) != jit.promote(self._arity) + 1:
+            return Fn.invoke_vals(self, vals, stack)
+        new_env = Env(vals, jit.promote(self._env))
+        return nil, stack.push(EnterContinuation(new_env, self._body))
+
+
+# Compiler
+#
+# Before a top level form runs, compile_toplevel turns it into a tree of
+# Nodes, so special forms are recognised once instead of every time the form
+# is evaluated. Each Node's eval returns a value or pushes the continuations
+# that finish evaluating it, just like the builtins' invoke.
+#
+# Symbols are resolved at the same time. Locals bound by fn and let become
+# LocalRefs holding a (depth, index) address into the chain of array-backed
+# Env frames, and everything else becomes a GlobalRef that goes straight to
+# the global registry. Each call of a fn gets one frame holding __self__
+# followed by its arguments; each let gets one frame for all of its bindings.
+
+class Node(Object):
+    _immutable_ = True
+    _type = Type("Node")
+
+    # form is the source the node was compiled from, kept for printing
+    def __init__(self, form):
+        self._form = form
+
+    def to_string(self):
+        return self._form.to_string()
+
+    # What the JIT prints for this node: the head of its form and the line
+    # the form was read from, instead of the whole form
+    def location(self):
+        form = self._form
+        if isinstance(form, SourceCons):
+            return "%s line %d" % (describe_form(form), form.line())
+        return describe_form(form)
+
+    def type(self):
+        return self._type
+
+    def eval(self, env, stack):
+        return nil, stack
+
+    # Simple nodes evaluate to a value without pushing anything
+    def is_simple(self):
+        return False
+
+
+def describe_form(form):
+    if isinstance(form, Cons):
+        head = form.car()
+        if isinstance(head, Symbol):
+            return "(%s ...)" % head.to_string()
+        return "(...)"
+    # Atoms that print short, anything else by its type
+    elif isinstance(form, Symbol):
+        return form.to_string()
+    elif isinstance(form, Integer):
+        return form.to_string()
+    elif isinstance(form, Boolean):
+        return form.to_string()
+    elif form is nil:
+        return "nil"
+    return form.type().to_string()
+
+
+class Const(Node):
+    _immutable_ = True
+
+    def __init__(self, form, val):
+        self._form = form
+        self._val = val
+
+    def eval(self, env, stack):
+        return self._val, stack
+
+    def is_simple(self):
+        return True
+
+
+class LocalRef(Node):
+    _immutable_ = True
+
+    def __init__(self, form, depth, index):
+        self._form = form
+        self._depth = depth
+        self._index = index
+
+    def eval(self, env, stack):
+        return env.lookup(self._depth, self._index), stack
+
+    def is_simple(self):
+        return True
+
+
+class GlobalRef(Node):
+    _immutable_ = True
+
+    def __init__(self, form, sym):
+        self._form = form
+        self._sym = sym
+
+    def eval(self, env, stack):
+        return global_registry.get_global(self._sym), stack
+
+    def is_simple(self):
+        return True
+
+
+class If(Node):
+    _immutable_ = True
+
+    def __init__(self, form, test, then, else_):
+        self._form = form
+        self._test = test
+        self._then = then
+        self._else = else_
+
+    def eval(self, env, stack):
+        return nil, stack.push(IfContinuation(env, self)) \
+                         .push(EvalExpr(env, self._test))
+
+
+class Do(Node):
+    _immutable_ = True
+    _immutable_fields_ = ["_exprs[*]"]
+
+    def __init__(self, form, exprs):
+        self._form = form
+        self._exprs = exprs
+
+    def eval(self, env, stack):
+        if len(self._exprs) == 0:
+            return nil, stack
+        return nil, stack.push(DoContinuation(env, self, 0))
+
+
+class Def(Node):
+    _immutable_ = True
+
+    def __init__(self, form, sym, value):
+        self._form = form
+        self._sym = sym
+        self._value = value
+
+    def eval(self, env, stack):
+        return nil, stack.push(DefContinuation(self._sym)) \
+                         .push(EvalExpr(env, self._value))
+
+
+class Cond(Node):
+    _immutable_ = True
+    _immutable_fields_ = ["_clauses[*]"]
 
-        return nil, stack.push(EvalExpr(new_env, self._body))
-
-def eval_sexpr(env, sym, args, stack):
-    if sym is if_sym:
-        return nil, stack.push(IfContinuation(env, args.cdr().car(), args.cdr().cdr().car())) \
-                         .push(EvalExpr(env, args.car()))
-    elif sym is do_sym:
-        return nil, stack.push(DoContinuation(env, args))
-    elif sym is def_sym:
-        return nil, stack.push(DefContinuation(args.car())) \
-                         .push(EvalExpr(env, args.cdr().car()))
-    elif sym is quote_sym:
-        return args.car(), stack
-    elif sym is cond_sym:
-        return nil, stack.push(CondContinuation(env, args.cdr())) \
-                         .push(EvalExpr(env, args.car()))
-    elif sym is resolve_sym:
+    # clauses alternates tests and bodies
+    def __init__(self, form, clauses):
+        self._form = form
+        self._clauses = clauses
+
+    def eval(self, env, stack):
+        if len(self._clauses) == 0:
+            return nil, stack
+        return nil, stack.push(CondContinuation(env, self, 0)) \
+                         .push(EvalExpr(env, self._clauses[0]))
+
+
+class Resolve(Node):
+    _immutable_ = True
+
+    def __init__(self, form, value):
+        self._form = form
+        self._value = value
+
+    def eval(self, env, stack):
         return nil, stack.push(ResolveContinuation()) \
-                         .push(EvalExpr(env, args.car()))
-    elif sym is let_sym:
-        binds = args.car()
-        body = args.cdr()
-        return nil, stack.push(LetContinuation(env, binds.car(), binds.cdr().cdr(), body)) \
-                         .push(EvalExpr(env, binds.cdr().car()))
-    elif sym is fn_sym:
-        arg_list = args.car()
-        body = Cons(do_sym, args.cdr())
-        return Lambda(env, arg_list, body), stack
+                         .push(EvalExpr(env, self._value))
 
-    return nil, stack.push(EvalApply(env, args)) \
-                     .push(EvalExpr(env, sym))
 
-def eval_one(env, expr, stack):
-    expr = jit.promote(expr)
-    if isinstance(expr, Cons):
-        if isinstance(expr.car(), Symbol):
-            return eval_sexpr(env, expr.car(), expr.cdr(), stack)
-        else:
-            return nil, stack.push(EvalApply(env, expr.cdr())) \
-                             .push(EvalExpr(env, expr.car()))
-    elif isinstance(expr, Symbol):
-        return env.lookup(expr), stack
-    else:
-        return expr, stack
+class Let(Node):
+    _immutable_ = True
+    _immutable_fields_ = ["_inits[*]"]
 
-class Globals(object):
-    _immutable_fields_ = ["_globals", "_rev?", "_mutable_globals"]
-    def __init__(self):
-        self._globals = {}
-        self._mutable_globals = {}
-        self._rev = 0
+    def __init__(self, form, inits, body):
+        self._form = form
+        self._inits = inits
+        self._body = body
 
-    def mark_mutable(self, k):
-        self._mutable_globals[k] = k
-        self._rev += 1
+    def eval(self, env, stack):
+        let_env = Env([nil] * len(self._inits), env)
+        if len(self._inits) == 0:
+            return nil, stack.push(EvalExpr(let_env, self._body))
+        return nil, stack.push(LetContinuation(let_env, self, 0)) \
+                         .push(EvalExpr(let_env, self._inits[0]))
 
-    @jit.elidable_promote()
-    def _is_mutable(self, k, rev):
-        return k in self._mutable_globals
 
-    def is_mutable(self, k):
-        return self._is_mutable(k, self._rev)
+# Binds like let. The body refers back to the Loop from its Recurs, so
+# compile_form sets it once the Loop exists.
+class Loop(Let):
+    _immutable_ = True
 
-    @jit.elidable_promote()
-    def _is_defined(self, k, rev):
-        return k in self._globals
+    def set_body(self, body):
+        self._body = body
 
-    def is_defined(self, k):
-        return self._is_mutable(k, self._rev)
 
-    def def_global(self, k, v):
-        if self.is_defined(k):
-            if not self.is_mutable(k):
-                self.mark_mutable(k)
+class Recur(Node):
+    _immutable_ = True
+    _immutable_fields_ = ["_args[*]"]
+
+    # depth counts the let frames between the recur and its loop's frame
+    def __init__(self, form, loop, depth, args):
+        self._form = form
+        self._loop = loop
+        self._depth = depth
+        self._args = args
+
+    # The next iteration gets a fresh frame next to the loop's current one,
+    # so closures made in earlier iterations keep their own bindings
+    def loop_env(self, env, vals):
+        loop_env = env.up(self._depth)
+        return Env(vals, loop_env._prev)
+
+    def eval(self, env, stack):
+        vals = [None] * len(self._args)
+        if len(self._args) == 0:
+            return nil, stack.push(LoopContinuation(self.loop_env(env, vals), self._loop))
+        return nil, stack.push(RecurContinuation(env, self, 0, vals)) \
+                         .push(EvalExpr(env, self._args[0]))
+
+
+class FnNode(Node):
+    _immutable_ = True
+
+    def __init__(self, form, arity, body):
+        self._form = form
+        self._arity = arity
+        self._body = body
+
+    def eval(self, env, stack):
+        return Lambda(env, self._arity, self._body), stack
+
+
+class Call(Node):
+    _immutable_ = True
+    _immutable_fields_ = ["_args[*]"]
+
+    def __init__(self, form, fn, args):
+        self._form = form
+        self._fn = fn
+        self._args = args
+
+    def eval(self, env, stack):
+        vals = [None] * (len(self._args) + 1)
+        return nil, stack.push(EvalApply(env, self, 0, vals)) \
+                         .push(EvalExpr(env, self._fn))
+
+
+# A call of one of the global_fns builtins whose arguments are all simple.
+# The arguments are evaluated in place and the builtin invoked directly,
+# without the EvalApply and ApplyContinuation steps. If the global has
+# been redefined since, it falls back to a normal call.
+class BuiltinCall(Call):
+    _immutable_ = True
+
+    def __init__(self, form, fn, args, sym, builtin):
+        self._form = form
+        self._fn = fn
+        self._args = args
+        self._sym = sym
+        self._builtin = builtin
+
+    @jit.unroll_safe
+    def eval(self, env, stack):
+        if global_registry.get_global(self._sym) is not self._builtin:
+            return Call.eval(self, env, stack)
+        args = nil
+        i = len(self._args) - 1
+        while i >= 0:
+            val, _ = self._args[i].eval(env, stack)
+            args = Cons(val, args)
+            i -= 1
+        return self._builtin.invoke(args, stack)
+
+
+class Scope(object):
+    # loop is the Loop binding this scope's syms, is_fn marks a fn's params
+    def __init__(self, syms, parent, loop=None, is_fn=False):
+        self._syms = syms
+        self._parent = parent
+        self._loop = loop
+        self._is_fn = is_fn
+
+    def add(self, sym):
+        self._syms.append(sym)
+
+    def resolve(self, sym):
+        depth = 0
+        scope = self
+        while scope is not None:
+            # Searched from the end so a later binding of the same name wins
+            i = len(scope._syms) - 1
+            while i >= 0:
+                if scope._syms[i] is sym:
+                    return LocalRef(sym, depth, i)
+                i -= 1
+            scope = scope._parent
+            depth += 1
+        return GlobalRef(sym, sym)
+
+    # The innermost loop around this scope and how many frames up its frame
+    # is. A recur can't reach a loop outside of its fn.
+    def find_loop(self):
+        depth = 0
+        scope = self
+        while scope is not None and not scope._is_fn:
+            if scope._loop is not None:
+                return scope._loop, depth
+            scope = scope._parent
+            depth += 1
+        return None, 0
+
+
+def list_length(lst):
+    count = 0
+    while lst is not nil:
+        count += 1
+        lst = lst.cdr()
+    return count
+
+
+# Nodes keep their children in fixed-size lists, which the JIT can treat as
+# immutable
+def fixed_list(acc):
+    result = [None] * len(acc)
+    for i in range(len(acc)):
+        result[i] = acc[i]
+    return result
+
+
+def fixed_int_list(acc):
+    result = [0] * len(acc)
+    for i in range(len(acc)):
+        result[i] = acc[i]
+    return result
+
+
+# tail says whether the last form is in tail position
+def compile_list(forms, scope, tail=False):
+    acc = []
+    while isinstance(forms, Cons):
+        acc.append(compile_form(forms.car(), scope, tail and forms.cdr() is nil))
+        forms = forms.cdr()
+    return fixed_list(acc)
+
+
+# The bodies of a cond are in tail position when the cond is, its tests
+# never are
+def compile_cond(clauses, scope, tail):
+    acc = []
+    is_body = False
+    while isinstance(clauses, Cons):
+        acc.append(compile_form(clauses.car(), scope, tail and is_body))
+        is_body = not is_body
+        clauses = clauses.cdr()
+    return fixed_list(acc)
+
+
+def all_const(nodes):
+    for node in nodes:
+        if not isinstance(node, Const):
+            return False
+    return True
+
+
+def all_simple(nodes):
+    for node in nodes:
+        if not node.is_simple():
+            return False
+    return True
+
+
+# Each init sees the bindings before it
+def compile_bindings(binds, scope):
+    inits = []
+    while binds is not nil:
+        inits.append(compile_form(binds.cdr().car(), scope))
+        scope.add(binds.car())
+        binds = binds.cdr().cdr()
+    return fixed_list(inits)
+
+
+def compile_body(form, forms, scope, tail):
+    return Do(form, compile_list(forms, scope, tail))
+
+
+class CompileError(Exception):
+    pass
+
+
+# tail is true for a form whose value is the value of the innermost
+# enclosing loop body. Only those can recur.
+def compile_form(form, scope, tail=False):
+    if isinstance(form, Symbol):
+        if scope is None:
+            return GlobalRef(form, form)
+        return scope.resolve(form)
+    elif isinstance(form, Vector):
+        # A vector of constants is its own value, any other builds a new
+        # vector out of its evaluated items. Only simple items can be
+        # evaluated in place, the rest need a full call.
+        item_nodes = fixed_list([compile_form(itm, scope) for itm in form._items])
+        if all_const(item_nodes):
+            return Const(form, form)
+        fn = Const(vector_sym, VectorFn)
+        if all_simple(item_nodes):
+            return BuiltinCall(form, fn, item_nodes, vector_sym, VectorFn)
+        return Call(form, fn, item_nodes)
+    elif not isinstance(form, Cons):
+        return Const(form, form)
+
+    head = form.car()
+    args = form.cdr()
+    if head is quote_sym:
+        return Const(form, args.car())
+    elif head is if_sym:
+        test = compile_form(args.car(), scope)
+        then = compile_form(args.cdr().car(), scope, tail)
+        if args.cdr().cdr() is nil:
+            else_ = Const(nil, nil)
         else:
-            self._rev += 1
+            else_ = compile_form(args.cdr().cdr().car(), scope, tail)
+        return If(form, test, then, else_)
+    elif head is do_sym:
+        return compile_body(form, args, scope, tail)
+    elif head is def_sym:
+        return Def(form, args.car(), compile_form(args.cdr().car(), scope))
+    elif head is cond_sym:
+        return Cond(form, compile_cond(args, scope, tail))
+    elif head is resolve_sym:
+        return Resolve(form, compile_form(args.car(), scope))
+    elif head is let_sym:
+        let_scope = Scope([], scope)
+        inits = compile_bindings(args.car(), let_scope)
+        return Let(form, inits, compile_body(form, args.cdr(), let_scope, tail))
+    elif head is loop_sym:
+        loop_scope = Scope([], scope)
+        loop = Loop(form, compile_bindings(args.car(), loop_scope), None)
+        loop_scope._loop = loop
+        loop.set_body(compile_body(form, args.cdr(), loop_scope, True))
+        return loop
+    elif head is recur_sym and scope is not None:
+        loop, depth = scope.find_loop()
+        if loop is not None:
+            if not tail:
+                print("Can only recur from tail position: " + form.to_string())
+                raise CompileError()
+            if list_length(args) != len(loop._inits):
+                print("Mismatched argument count to recur, expected %d args, got %d: %s"
+                      % (len(loop._inits), list_length(args), form.to_string()))
+                raise CompileError()
+            return Recur(form, loop, depth, compile_list(args, scope))
+    elif head is fn_sym:
+        arg_list = args.car()
+        syms = [self_sym]
+        while arg_list is not nil:
+            syms.append(arg_list.car())
+            arg_list = arg_list.cdr()
+        fn_scope = Scope(syms, scope, is_fn=True)
+        return FnNode(form, len(syms) - 1, compile_body(form, args.cdr(), fn_scope, False))
+
+    fn = compile_form(head, scope)
+    arg_nodes = compile_list(args, scope)
+    if isinstance(fn, GlobalRef) and fn._sym in global_fns and all_simple(arg_nodes):
+        return BuiltinCall(form, fn, arg_nodes, fn._sym, global_fns[fn._sym])
+    return Call(form, fn, arg_nodes)
+
+
+def compile_toplevel(form):
+    return compile_form(form, None)
+
+class Globals(object):
+    # Globals live in the cells of their Symbols. This only remembers which
+    # cells have been defined, so clear can empty them again.
+    def __init__(self):
+        self._defined = []
+
+    def is_defined(self, k):
+        return k._cell.get() is not None
 
-        self._globals[k] = v
+    def is_mutable(self, k):
+        return k._cell.is_mutable()
 
-    @jit.elidable_promote()
-    def _get_global_constant(self, k, rev):
-        return self._globals[k]
+    # Only binding a defined symbol to something else makes it mutable.
+    # Defining it for the first time, again after clear, or again with the
+    # value it already has doesn't.
+    def def_global(self, k, v):
+        assert isinstance(k, Symbol)
+        cell = k._cell
+        if not self.is_defined(k):
+            self._defined.append(cell)
+        elif cell.get() is v:
+            return
+        elif not self.is_mutable(k):
+            cell.mark_mutable()
+        cell.set(v)
 
     def get_global(self, k):
-        try:
-            if self.is_mutable(k):
-                return self._globals[k]
-            else:
-                return self._get_global_constant(k, self._rev)
-        except KeyError:
-            print("Global not defined: " + k._str_val )
-            raise
+        assert isinstance(k, Symbol)
+        val = k._cell.get()
+        if val is None:
+            print("Global not defined: " + k._str_val)
+            raise KeyError
+        return val
 
     def clear(self):
-        self._globals.clear()
+        for cell in self._defined:
+            cell.set(None)
+        self._defined = []
 
 class Env(object):
-    _immutable_ = True
-    #_virtualizable_ = ["_k", "_v", "_prev"]
+    _immutable_fields_ = ["_vals", "_prev"]
 
-    def __init__(self, k=self_sym, v=nil, prev=None):
-        self._k = k
-        self._v = v
+    # vals is sized up front and never grows, so it stays a fixed-size array
+    # the JIT can virtualize along with the frame.
+    def __init__(self, vals, prev=None):
+        self._vals = vals
         self._prev = prev
 
-    def bind(self, k, v):
-        return Env(k, v, self)
+    def set(self, index, v):
+        self._vals[index] = v
 
     @jit.unroll_safe
-    def lookup(self, sym):
-        sym = jit.promote(sym)
+    def up(self, depth):
         env = self
-        while env is not None:
-            if jit.promote(env._k) is sym:
-                return env._v
+        for i in range(depth):
             env = env._prev
-        return global_registry.get_global(sym)
+        return env
+
+    def lookup(self, depth, index):
+        return self.up(depth)._vals[index]
 
 
 
@@ -876,57 +2653,560 @@ def reset_globals():
 
 reset_globals()
 
-def get_location(prev, expr):
-    return prev.to_string() + " | " + expr.to_string()
-    #return "Unknown"
+def get_location(expr):
+    if isinstance(expr, Node):
+        return expr.location()
+    return describe_form(expr)
 
-jitdriver = jit.JitDriver(greens=['expr', 'prev_expr'], reds=["env", "stack", "val"],
-                          get_printable_location=get_location) #, virtualizables=["env"]
+# The node a continuation works on is the whole green key. Loops are entered
+# at a LoopContinuation, keyed by its Loop node, and fns at an
+# EnterContinuation, keyed by their body, so each loop and each fn gets one
+# entry no matter where it was reached from.
+jitdriver = jit.JitDriver(greens=['expr'], reds=["env", "stack", "val"],
+                          get_printable_location=get_location, is_recursive=True) #, virtualizables=["env"]
 
 
 
 def eval_all(expr):
-    env = jit.promote(Env(self_sym, nil))
+    env = jit.promote(Env([]))
     stack = jit.promote(tos)
-    val, stack = eval_one(env, expr, stack)
-    prev_expr = nil
+    val, stack = expr.eval(env, stack)
+    return eval_stack(env, val, stack)
+
+
+def eval_stack(env, val, stack):
     expr = nil
 
     while stack.has_more():
-        jitdriver.jit_merge_point(expr=expr, prev_expr=prev_expr, env=env, stack=stack, val=val)
+        jitdriver.jit_merge_point(expr=expr, env=env, stack=stack, val=val)
         k, stack = stack.pop()
 
-        prev_expr = expr
         expr = k.expr()
         can_enter = k.can_enter_jit()
         val, stack = k.call_continuation(val, stack)
 
         if can_enter:
-            jitdriver.can_enter_jit(expr=expr, prev_expr=prev_expr, env=env, stack=stack, val=val)
+            jitdriver.can_enter_jit(expr=expr, env=env, stack=stack, val=val)
 
 
     return val
 
 
+# Bytecode engine
+#
+# The alternative to the continuation machine in eval_all, picked with
+# --engine bytecode. Each fn body (and each top level form) is flattened from
+# its Nodes into a Code object, which run_code executes in a dispatch loop
+# over an explicit chain of VMFrames, so calls don't recurse on the host
+# stack either. Values, Lambdas and Env frames are shared with the other
+# engine.
+
+CONST = 0          # idx: push consts[idx]
+LOCAL = 1          # depth, index: push a local from the env chain
+GLOBAL = 2         # idx: push the global named consts[idx]
+JUMP = 3           # target
+JUMP_IF_FALSE = 4  # target: pop, jump if nil or false
+POP = 5
+DEF = 6            # idx: define consts[idx] as the top of the stack
+RESOLVE = 7        # replace the symbol on top of the stack by its global
+MAKE_FN = 8        # idx: push a Lambda for fns[idx] closing over the env
+LET = 9            # n: enter a let frame with n slots
+LET_SET = 10       # index: pop into a slot of the let frame
+LET_END = 11       # leave the let frame
+CALL = 12          # argc: call the fn below the argc arguments
+RETURN = 13
+TAIL_CALL = 14     # argc: like CALL, but a Lambda replaces the current frame
+RECUR = 15         # depth, argc, target, sp: rebind the loop depth frames up
+                   # and jump back to its body with the stack cut to sp
+
+opcode_names = ["CONST", "LOCAL", "GLOBAL", "JUMP", "JUMP_IF_FALSE", "POP", "DEF", "RESOLVE",
+                "MAKE_FN", "LET", "LET_SET", "LET_END", "CALL", "RETURN", "TAIL_CALL", "RECUR"]
+
+
+class Code(object):
+    _immutable_fields_ = ["name", "bytecode[*]", "consts[*]", "fns[*]", "max_stack"]
+
+    def __init__(self, name, bytecode, consts, fns, max_stack):
+        self.name = name
+        self.bytecode = bytecode
+        self.consts = consts
+        self.fns = fns
+        self.max_stack = max_stack
+
+
+class CodeBuilder(object):
+    def __init__(self):
+        self._bytecode = []
+        self._consts = []
+        self._fns = []
+        self._depth = 0
+        self._max_depth = 0
+        self._loops = []
+        self._loop_starts = []
+        self._loop_depths = []
+
+    def emit(self, op, delta):
+        self._bytecode.append(op)
+        self._depth += delta
+        if self._depth > self._max_depth:
+            self._max_depth = self._depth
+
+    def emit_arg(self, arg):
+        self._bytecode.append(arg)
+
+    def here(self):
+        return len(self._bytecode)
+
+    # Emits a jump and returns the position of its target, to be patched
+    def emit_jump(self, op, delta):
+        self.emit(op, delta)
+        self.emit_arg(-1)
+        return self.here() - 1
+
+    def patch(self, pos):
+        self._bytecode[pos] = self.here()
+
+    def const_index(self, val):
+        for i in range(len(self._consts)):
+            if self._consts[i] is val:
+                return i
+        self._consts.append(val)
+        return len(self._consts) - 1
+
+    # tail is set for a node whose value is returned straight from the code,
+    # calls there become TAIL_CALLs so loops run in constant space
+    def compile(self, node, tail=False):
+        if isinstance(node, Const):
+            self.emit(CONST, 1)
+            self.emit_arg(self.const_index(node._val))
+        elif isinstance(node, LocalRef):
+            self.emit(LOCAL, 1)
+            self.emit_arg(node._depth)
+            self.emit_arg(node._index)
+        elif isinstance(node, GlobalRef):
+            self.emit(GLOBAL, 1)
+            self.emit_arg(self.const_index(node._sym))
+        elif isinstance(node, If):
+            self.compile(node._test)
+            to_else = self.emit_jump(JUMP_IF_FALSE, -1)
+            self.compile(node._then, tail)
+            to_end = self.emit_jump(JUMP, -1)
+            self.patch(to_else)
+            self.compile(node._else, tail)
+            self.patch(to_end)
+        elif isinstance(node, Do):
+            if len(node._exprs) == 0:
+                self.emit(CONST, 1)
+                self.emit_arg(self.const_index(nil))
+            for i in range(len(node._exprs)):
+                if i > 0:
+                    self.emit(POP, -1)
+                self.compile(node._exprs[i], tail and i == len(node._exprs) - 1)
+        elif isinstance(node, Def):
+            self.compile(node._value)
+            self.emit(DEF, 0)
+            self.emit_arg(self.const_index(node._sym))
+        elif isinstance(node, Cond):
+            to_end = []
+            i = 0
+            while i + 1 < len(node._clauses):
+                self.compile(node._clauses[i])
+                to_next = self.emit_jump(JUMP_IF_FALSE, -1)
+                self.compile(node._clauses[i + 1], tail)
+                to_end.append(self.emit_jump(JUMP, -1))
+                self.patch(to_next)
+                i += 2
+            self.emit(CONST, 1)
+            self.emit_arg(self.const_index(nil))
+            for pos in to_end:
+                self.patch(pos)
+        elif isinstance(node, Resolve):
+            self.compile(node._value)
+            self.emit(RESOLVE, 0)
+        elif isinstance(node, Loop):
+            self.emit(LET, 0)
+            self.emit_arg(len(node._inits))
+            for i in range(len(node._inits)):
+                self.compile(node._inits[i])
+                self.emit(LET_SET, -1)
+                self.emit_arg(i)
+            self._loops.append(node)
+            self._loop_starts.append(self.here())
+            self._loop_depths.append(self._depth)
+            self.compile(node._body, tail)
+            self.emit(LET_END, 0)
+        elif isinstance(node, Recur):
+            for arg in node._args:
+                self.compile(arg)
+            # Control never comes back, counted as leaving a value like any
+            # other expression
+            self.emit(RECUR, 1 - len(node._args))
+            self.emit_arg(node._depth)
+            self.emit_arg(len(node._args))
+            i = self.loop_index(node._loop)
+            self.emit_arg(self._loop_starts[i])
+            self.emit_arg(self._loop_depths[i])
+        elif isinstance(node, Let):
+            self.emit(LET, 0)
+            self.emit_arg(len(node._inits))
+            for i in range(len(node._inits)):
+                self.compile(node._inits[i])
+                self.emit(LET_SET, -1)
+                self.emit_arg(i)
+            self.compile(node._body, tail)
+            self.emit(LET_END, 0)
+        elif isinstance(node, FnNode):
+            self._fns.append(node)
+            self.emit(MAKE_FN, 1)
+            self.emit_arg(len(self._fns) - 1)
+        elif isinstance(node, Call):
+            self.compile(node._fn)
+            for arg in node._args:
+                self.compile(arg)
+            self.emit(TAIL_CALL if tail else CALL, -len(node._args))
+            self.emit_arg(len(node._args))
+        else:
+            assert False, "can't compile node"
+
+    def loop_index(self, loop):
+        for i in range(len(self._loops)):
+            if self._loops[i] is loop:
+                return i
+        assert False, "recur outside of its loop"
+
+    def build(self, name):
+        self.emit(RETURN, -1)
+        return Code(name, fixed_int_list(self._bytecode), fixed_list(self._consts),
+                    fixed_list(self._fns), self._max_depth)
+
+
+def compile_code(node):
+    builder = CodeBuilder()
+    builder.compile(node, True)
+    name = node.to_string()
+    if len(name) > 40:
+        name = name[:40] + "..."
+    return builder.build(name)
+
+
+class CodeCache(object):
+    def __init__(self):
+        self._codes = {}
+
+    # Fn bodies are compiled the first time they are called
+    @jit.elidable
+    def get(self, node):
+        code = self._codes.get(node, None)
+        if code is None:
+            code = compile_code(node)
+            self._codes[node] = code
+        return code
+
+code_cache = CodeCache()
+
+
+class VMFrame(object):
+    def __init__(self, code, env, caller):
+        self.code = code
+        self.env = env
+        self.caller = caller
+        self.stack = [None] * code.max_stack
+        self.sp = 0
+        self.pc = 0
+
+    def push(self, v):
+        self.stack[self.sp] = v
+        self.sp += 1
+
+    def pop(self):
+        self.sp -= 1
+        v = self.stack[self.sp]
+        self.stack[self.sp] = None
+        return v
+
+    def peek(self, depth):
+        return self.stack[self.sp - depth - 1]
+
+    @jit.unroll_safe
+    def pop_list(self, count):
+        acc = nil
+        for i in range(count):
+            acc = Cons(self.pop(), acc)
+        return acc
+
+    # Pops the arguments and then the fn of a call straight into a new frame
+    @jit.unroll_safe
+    def pop_call_env(self, fn, argc):
+        arity = jit.promote(fn._arity)
+        vals = [nil] * (arity + 1)
+        vals[0] = fn
+        i = argc
+        while i > 0:
+            v = self.pop()
+            if i <= arity:
+                vals[i] = v
+            i -= 1
+        self.pop()
+        return Env(vals, jit.promote(fn._env))
+
+
+def call_builtin(fn, args):
+    val, stack = fn.invoke(args, tos)
+    if stack.has_more():
+        # Builtins that evaluate code hand back continuations
+        val = eval_stack(Env([]), val, stack)
+    return val
+
+
+def get_vm_location(pc, code):
+    return "%s @%d %s" % (code.name, pc, opcode_names[code.bytecode[pc]])
+
+# Both engines can run inside each other, through load-file and the
+# builtins that call back into the continuation machine
+vm_jitdriver = jit.JitDriver(greens=["pc", "code"], reds=["frame"],
+                             get_printable_location=get_vm_location, is_recursive=True)
+
+
+def run_code(code, env):
+    frame = VMFrame(code, env, None)
+    pc = 0
+
+    while True:
+        vm_jitdriver.jit_merge_point(pc=pc, code=code, frame=frame)
+        op = code.bytecode[pc]
+
+        if op == CONST:
+            frame.push(code.consts[code.bytecode[pc + 1]])
+            pc += 2
+        elif op == LOCAL:
+            frame.push(frame.env.lookup(code.bytecode[pc + 1], code.bytecode[pc + 2]))
+            pc += 3
+        elif op == GLOBAL:
+            sym = code.consts[code.bytecode[pc + 1]]
+            assert isinstance(sym, Symbol)
+            frame.push(global_registry.get_global(sym))
+            pc += 2
+        elif op == JUMP:
+            pc = code.bytecode[pc + 1]
+        elif op == JUMP_IF_FALSE:
+            val = frame.pop()
+            if val is nil or val is false:
+                pc = code.bytecode[pc + 1]
+            else:
+                pc += 2
+        elif op == POP:
+            frame.pop()
+            pc += 1
+        elif op == DEF:
+            sym = code.consts[code.bytecode[pc + 1]]
+            assert isinstance(sym, Symbol)
+            global_registry.def_global(sym, frame.peek(0))
+            pc += 2
+        elif op == RESOLVE:
+            frame.push(global_registry.get_global(frame.pop()))
+            pc += 1
+        elif op == MAKE_FN:
+            fn_node = code.fns[code.bytecode[pc + 1]]
+            frame.push(Lambda(frame.env, fn_node._arity, fn_node._body))
+            pc += 2
+        elif op == LET:
+            env = frame.env
+            frame.env = Env([nil] * code.bytecode[pc + 1], env)
+            pc += 2
+        elif op == LET_SET:
+            frame.env.set(code.bytecode[pc + 1], frame.pop())
+            pc += 2
+        elif op == LET_END:
+            frame.env = frame.env._prev
+            pc += 1
+        elif op == RECUR:
+            argc = code.bytecode[pc + 2]
+            vals = [None] * argc
+            i = argc - 1
+            while i >= 0:
+                vals[i] = frame.pop()
+                i -= 1
+            loop_env = frame.env.up(code.bytecode[pc + 1])
+            frame.env = Env(vals, loop_env._prev)
+            # Anything left above the loop's depth is popped, which clears
+            # its slot, so the GC doesn't keep it alive
+            depth = code.bytecode[pc + 4]
+            while frame.sp > depth:
+                frame.pop()
+            pc = code.bytecode[pc + 3]
+            vm_jitdriver.can_enter_jit(pc=pc, code=code, frame=frame)
+        elif op == CALL or op == TAIL_CALL:
+            argc = code.bytecode[pc + 1]
+            pc += 2
+            fn = frame.peek(argc)
+            if isinstance(fn, Lambda):
+                callee = fn
+                new_env = frame.pop_call_env(fn, argc)
+            else:
+                args = frame.pop_list(argc)
+                frame.pop()
+                # apply and vararg would hand a Lambda back to the continuation
+                # machine, unwrap them so the callee runs here
+                while True:
+                    if isinstance(fn, VarArgLambda):
+                        args = Cons(args)
+                        fn = fn._fn
+                    elif fn is Apply:
+                        fn, args = args.car(), args.cdr().car()
+                    else:
+                        break
+                if not isinstance(fn, Lambda):
+                    frame.push(call_builtin(fn, args))
+                    continue
+                callee = fn
+                new_env = callee.make_env(args)
+
+            code = code_cache.get(callee._body)
+            if op == TAIL_CALL:
+                frame = VMFrame(code, new_env, frame.caller)
+            else:
+                frame.pc = pc
+                frame = VMFrame(code, new_env, frame)
+            pc = 0
+            vm_jitdriver.can_enter_jit(pc=pc, code=code, frame=frame)
+        elif op == RETURN:
+            val = frame.pop()
+            frame = frame.caller
+            if frame is None:
+                return val
+            code = frame.code
+            pc = frame.pc
+            frame.push(val)
+        else:
+            assert False, "unknown opcode"
+
+
 # Entry Point code
 
-def run(filename):
-    rdr = PushbackReader(FileReader(filename))
-    forms = read_all(rdr)
-    result = eval_all(forms)
+class Config(object):
+    def __init__(self):
+        self.engine = "cps"
+        self.jit_stats = False
+
+config = Config()
+
+engines = ["cps", "bytecode"]
+
+
+# Reports what the JIT did during a run, from the counters it keeps about
+# itself. Only a translated build has them.
+class JitStats(object):
+    def __init__(self):
+        self._started = 0.0
+
+    def start(self):
+        self._started = time.time()
+
+    def counter(self, no):
+        return jit_hooks.stats_get_counter_value(None, no)
+
+    def millis(self, no):
+        return int(jit_hooks.stats_get_times_value(None, no) * 1000)
+
+    def report(self):
+        if not objectmodel.we_are_translated():
+            print("JIT stats are only kept by a translated build")
+            return
+        running = int((time.time() - self._started) * 1000)
+
+        loops = self.counter(jit.Counters.TOTAL_COMPILED_LOOPS)
+        bridges = self.counter(jit.Counters.TOTAL_COMPILED_BRIDGES)
+        print("JIT stats")
+        print("  loops compiled: %d" % loops)
+        # Each bridge starts at a guard that failed often enough to be
+        # traced, the JIT keeps no count of the guard failures themselves
+        print("  bridges compiled: %d" % bridges)
+        # The rest is only counted once the JIT has traced something
+        if loops + bridges > 0:
+            aborted = 0
+            for no in [jit.Counters.ABORT_TOO_LONG, jit.Counters.ABORT_BRIDGE,
+                       jit.Counters.ABORT_BAD_LOOP, jit.Counters.ABORT_ESCAPE,
+                       jit.Counters.ABORT_FORCE_QUASIIMMUT]:
+                aborted += self.counter(no)
+            tracing = self.millis(jit.Counters.TRACING)
+            compiling = self.millis(jit.Counters.BACKEND)
+            running -= tracing + compiling
+            print("  traces started: %d" % self.counter(jit.Counters.TRACING))
+            print("  traces aborted: %d" % aborted)
+            print("  tracing: %d ms" % tracing)
+            print("  compiling: %d ms" % compiling)
+        print("  running: %d ms" % running)
+
+jit_stats = JitStats()
+
+
+def eval_toplevel(node):
+    if config.engine == "bytecode":
+        return run_code(compile_code(node), Env([]))
+    return eval_all(node)
 
 
+def run(filename):
+    if config.jit_stats:
+        jit_stats.start()
+    forms = load_forms(filename)
+    try:
+        result = eval_toplevel(compile_toplevel(forms))
+    except CompileError:
+        # Raised by this file or one it loads, after printing what's wrong
+        return 1
+
+    if config.jit_stats:
+        jit_stats.report()
     return 0
 
 
+def usage():
+    print("usage: in_rpython_jit-c [--engine cps|bytecode] [--jit param=value,...|off] [--jit-stats] file.clj")
+    print("  --jit        sets JIT parameters, e.g. threshold=200,function_threshold=300,trace_limit=10000,")
+    print("               or turns the JIT off")
+    print("  --jit-stats  reports the loops and bridges compiled and the time spent tracing, compiling")
+    print("               and running at exit")
+    return 1
+
+
 def entry_point(argv):
-    return run(argv[1])
+    file_name = None
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        if arg == "--engine" and i + 1 < len(argv):
+            i += 1
+            if argv[i] not in engines:
+                return usage()
+            config.engine = argv[i]
+        elif arg == "--jit" and i + 1 < len(argv):
+            i += 1
+            try:
+                jit.set_user_param(None, argv[i])
+            except (ValueError, jit.TraceLimitTooHigh):
+                print("Bad JIT parameters: %s" % argv[i])
+                return usage()
+        elif arg == "--jit-stats":
+            config.jit_stats = True
+        elif arg.startswith("--"):
+            # An unknown flag or one missing its value
+            return usage()
+        elif file_name is None:
+            file_name = argv[i]
+        else:
+            return usage()
+        i += 1
+
+    if file_name is None:
+        return usage()
+    return run(file_name)
 
 def target(*args):
     return entry_point, None
 
 if __name__ == "__main__":
-    entry_point(["_", "src/lisp_in_x/tests.clj"])
+    entry_point(["_"] + sys.argv[1:] if len(sys.argv) > 1 else ["_", "src/lisp_in_x/tests.clj"])
 
 
 
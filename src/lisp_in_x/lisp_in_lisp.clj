@@ -5,23 +5,30 @@
 
 (def globals nil)
 
+;; globals and envs are hash maps, and a missing key is looked up as this
+(def not-found (cons 'not 'found))
+
 (def def-global
   (fn [sym val]
-    (def globals (replace-assoc globals sym val))))
+    (def globals (assoc globals sym val))))
 
 (def get-global
   (fn [sym]
-    (lookup-assoc-or globals sym
-                     (fn [sym2]
-                       (die "Global not defined" 'sym sym 'sym2 sym2)))))
+    (let [val (get globals sym not-found)]
+      (if (= val not-found)
+        (die "Global not defined" 'sym sym)
+        val))))
 
 (def bind
   (fn [env sym val]
-    (append-assoc env sym val)))
+    (assoc env sym val)))
 
 (def lookup
   (fn [env sym]
-    (lookup-assoc-or env sym get-global)))
+    (let [val (get env sym not-found)]
+      (if (= val not-found)
+        (get-global sym)
+        val))))
 
 (def eval-list
   (fn [env lst]
@@ -113,8 +120,8 @@
       (symbol? form) (lookup env form)
       true form)))
 
-(def builtins '[println + * - / < > <= >= = dec inc car cdr cons cons? symbol? apply
-                load-file nil? vararg load-file die read-file])
+(def builtins '(println + * - / < > <= >= = dec inc car cdr cons cons? symbol? apply
+                load-file nil? vararg load-file die read-file hash-map get assoc dissoc))
 
 (def add-globals
   (fn [l]
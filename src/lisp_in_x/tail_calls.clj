@@ -0,0 +1,22 @@
+;; Loops ten million times through tail calls. Meant to be run translated,
+;; memory use should stay flat however long it runs:
+;; ./in_rpython_jit-c src/lisp_in_x/tail_calls.clj
+;; Nothing runs it automatically. TestTailCalls in test_jit.py checks that
+;; the stack stays as deep after many iterations as after a few.
+
+(def count-up
+  (fn [i n]
+    (if (< i n)
+      (count-up (inc i) n)
+      i)))
+
+(println "count-up 10000000 = " (count-up 0 10000000))
+
+(def count-down
+  (fn [n]
+    (cond
+      (= n 0) (quote done)
+      true (let [m (dec n)]
+             (do nil (count-down m))))))
+
+(println "count-down 10000000 = " (count-down 10000000))
@@ -0,0 +1,362 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from rpython.jit.metainterp.test.support import LLJitMixin, get_stats
+
+import in_rpython_jit as interp
+import in_rpython as nojit
+
+# JIT regression tests. They run the tracer on the untranslated interpreter,
+# which takes a few minutes:
+# python -m pytest src/lisp_in_x/test_jit.py
+
+
+class StringReader(interp.Reader):
+    def __init__(self, source):
+        interp.Reader.__init__(self)
+        self._source = source
+        self._pos = 0
+
+    def read(self):
+        if self._pos >= len(self._source):
+            raise EOFError()
+        ch = self._source[self._pos]
+        self._pos += 1
+        return ord(ch)
+
+    def unread(self, ch):
+        self._pos -= 1
+
+    def mark(self):
+        return self._pos
+
+    def slice(self, start, end):
+        return self._source[start:end]
+
+
+def compile_source(source):
+    return interp.compile_toplevel(interp.read_all(StringReader(source)))
+
+
+def read_cells(loop):
+    # Reads of a global's value that survived into the loop
+    return [op for op in loop.operations
+            if op.getopname().startswith("getfield")
+            and "_value" in repr(op.getdescr())]
+
+
+class JitTest(LLJitMixin):
+    # Runs setup untranslated, so the globals it defines are part of the
+    # prebuilt state, then traces loop in steady state
+    def trace_loops(self, setup, loop):
+        interp.reset_globals()
+        interp.eval_all(compile_source(setup))
+        loop = compile_source(loop)
+
+        def main(n):
+            return interp.eval_all(loop).int_val()
+
+        self.meta_interp(main, [0], listops=True)
+        loops = get_stats().get_all_loops()
+        assert loops
+        return loops
+
+
+class TestGlobals(JitTest):
+    def test_constant_global_folds(self):
+        loops = self.trace_loops(
+            "(def limit 100) (def step 1) (def limit 100)",
+            "(loop [i 0] (if (< i limit) (recur (+ i step)) i))")
+
+        for loop in loops:
+            assert read_cells(loop) == []
+
+    def test_rebound_global_is_read(self):
+        loops = self.trace_loops(
+            "(def limit 50) (def limit 100)",
+            "(loop [i 0] (if (< i limit) (recur (inc i)) i))")
+
+        for loop in loops:
+            assert read_cells(loop) != []
+
+    def test_only_rebinding_marks_mutable(self):
+        interp.reset_globals()
+        interp.eval_all(compile_source("(def a 1) (def b 2) (def a 3) (def b 2)"))
+
+        assert interp.global_registry.is_mutable(interp.Symbol.intern("a"))
+        assert not interp.global_registry.is_mutable(interp.Symbol.intern("b"))
+        assert not interp.global_registry.is_mutable(interp.Symbol.intern("+"))
+
+
+class TestEntries(JitTest):
+    def test_mutual_recursion_is_traced(self):
+        loops = self.trace_loops(
+            "(def ping (fn [n] (if (< n 1) 0 (pong (dec n)))))"
+            "(def pong (fn [n] (if (< n 1) 1 (ping (dec n)))))",
+            "(ping 1000)")
+
+        assert loops
+
+
+class ListStream(object):
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, s):
+        self.chunks.append(s)
+
+
+class TestLocations(object):
+    source = "(def f\n  (fn [n]\n    ; count down\n    (loop [i n]\n      (if (< i 1) i (recur (dec i))))))"
+
+    def test_loop_location(self):
+        forms = interp.read_all(StringReader(self.source))
+        fn = forms.cdr().car().cdr().cdr().car()
+        loop = fn.cdr().cdr().car()
+        node = interp.compile_form(loop, None)
+
+        assert isinstance(node, interp.Loop)
+        assert interp.get_location(node) == "(loop ...) line 4"
+
+    def test_lines_survive_the_cache(self):
+        stream = ListStream()
+        encoder = interp.FormEncoder(stream)
+        encoder.write_form(interp.read_all(StringReader(self.source)))
+        encoder.flush()
+        forms = interp.FormDecoder("".join(stream.chunks)).read_form()
+
+        fn = forms.cdr().car().cdr().cdr().car()
+        assert fn.line() == 2
+        assert fn.cdr().cdr().car().line() == 4
+
+
+class TestRecur(object):
+    rejected = ["(loop [i 0 j 7] (if (< i 3) (recur (inc i)) j))",
+                "(loop [i 0] (if (< i 3) (recur (inc i) 1) i))",
+                "(loop [i 0] (+ 1 (recur (inc i))))",
+                "(loop [i 0] (let [j (recur i)] j))",
+                "(loop [i 0] (if (recur i) 1 2))",
+                "(loop [i 0] (cond (recur i) 1))",
+                "(loop [i 0] (do (recur i) i))",
+                "(loop [i 0] [(recur i)])",
+                "(loop [i 0] (loop [j (recur i)] j))"]
+
+    def check_rejected(self, source):
+        try:
+            compile_source(source)
+        except interp.CompileError:
+            return
+        assert False, "compiled " + source
+
+    def run_no_jit(self, tmpdir, source):
+        main = tmpdir.join("main.clj")
+        main.write(source)
+        return nojit.entry_point(["_", str(main)])
+
+    # in_rpython.py has no compile step and checks each file's loops before
+    # running it instead
+    def test_no_jit_rejects_the_same_recurs(self, tmpdir):
+        for source in self.rejected:
+            self.check_rejected(source)
+            assert self.run_no_jit(tmpdir, "(println 1) " + source) == 1
+
+    def test_no_jit_fn_cant_recur_to_outer_loop(self, tmpdir):
+        for source in ["(loop [i 0] (if (< i 1) ((fn [] (recur 5))) i))",
+                       "(loop [i 0] (cons recur nil))"]:
+            try:
+                self.run_no_jit(tmpdir, source)
+            except KeyError:
+                continue
+            assert False, "ran " + source
+
+    def test_recur_needs_every_binding(self):
+        self.check_rejected("(loop [i 0 j 7] (if (< i 3) (recur (inc i)) j))")
+        self.check_rejected("(loop [i 0] (if (< i 3) (recur (inc i) 1) i))")
+
+    def test_recur_only_from_tail_position(self):
+        self.check_rejected("(loop [i 0] (+ 1 (recur (inc i))))")
+        self.check_rejected("(loop [i 0] (let [j (recur i)] j))")
+        self.check_rejected("(loop [i 0] (if (recur i) 1 2))")
+        self.check_rejected("(loop [i 0] (cond (recur i) 1))")
+        self.check_rejected("(loop [i 0] (do (recur i) i))")
+
+    def test_tail_positions_compile(self):
+        compile_source("(loop [i 0] (let [j i] (do (cond (< j 1) (recur 1) (< j 2) (if true (recur 2) 0)))))")
+
+
+class TestCache(object):
+    source = "(def f (fn [n] [n 'n \"n\" 123456789012345678901234]))"
+
+    def write_cache(self, tmpdir):
+        cache = str(tmpdir.join("f.clj.cache"))
+        forms = interp.read_all(StringReader(self.source))
+        interp.write_cached_forms(cache, 10, 20, forms)
+        return cache, forms
+
+    def test_mapped_cache_round_trip(self, monkeypatch, tmpdir):
+        monkeypatch.setattr(interp, "mmap_threshold", 1)
+        cache, forms = self.write_cache(tmpdir)
+
+        assert interp.read_cached_forms(cache, 10, 20).to_string() == forms.to_string()
+        assert interp.read_cached_forms(cache, 10, 21) is None
+
+    def test_bad_mapped_cache_is_ignored(self, monkeypatch, tmpdir):
+        monkeypatch.setattr(interp, "mmap_threshold", 1)
+        cache, forms = self.write_cache(tmpdir)
+        data = open(cache, "rb").read()
+
+        open(cache, "wb").write(data[:-3])
+        assert interp.read_cached_forms(cache, 10, 20) is None
+        open(cache, "wb").write("")
+        assert interp.read_cached_forms(cache, 10, 20) is None
+        assert interp.read_cached_forms(cache + ".missing", 10, 20) is None
+
+    def test_failed_write_leaves_no_tmp_file(self, monkeypatch, tmpdir):
+        def failing_rename(src, dst):
+            raise OSError(13, "Permission denied")
+
+        monkeypatch.setattr(interp.os, "rename", failing_rename)
+        cache, forms = self.write_cache(tmpdir)
+        assert tmpdir.listdir() == []
+
+    def test_overlong_varint_is_rejected(self):
+        decoder = interp.FormDecoder(interp.cache_magic + "\x80" * 20 + "\x01")
+        decoder.expect(interp.cache_magic)
+        try:
+            decoder.read_varint()
+        except interp.CacheError:
+            return
+        assert False, "decoded an overlong varint"
+
+
+class TestReaders(object):
+    def test_mapping_closed_on_parse_error(self, monkeypatch, tmpdir):
+        closed = []
+        close = interp.MappedFileReader.close
+
+        def counting_close(rdr):
+            closed.append(rdr)
+            close(rdr)
+
+        monkeypatch.setattr(interp, "mmap_threshold", 1)
+        monkeypatch.setattr(interp.MappedFileReader, "close", counting_close)
+        source = tmpdir.join("bad.clj")
+        source.write("(def a 1) )")
+        rdr = interp.open_reader(str(source))
+        assert isinstance(rdr, interp.MappedFileReader)
+        try:
+            interp.read_all_and_close(rdr)
+        except IndexError:
+            pass
+        assert closed == [rdr]
+
+    def test_empty_file_is_not_mapped(self, monkeypatch, tmpdir):
+        monkeypatch.setattr(interp, "mmap_threshold", 0)
+        source = tmpdir.join("empty.clj")
+        source.write("")
+        forms = interp.read_all_and_close(interp.open_reader(str(source)))
+        assert forms.cdr() is interp.nil
+
+
+class TestKeys(JitTest):
+    def test_recur_sites_share_a_loop(self):
+        loops = self.trace_loops(
+            "",
+            "(loop [i 0] (if (< i 1000) (if (< i 500) (recur (+ i 1)) (recur (+ i 2))) i))")
+
+        assert len(loops) == 1
+
+
+class TestTailCalls(object):
+    # The ten million iterations in tail_calls.clj are for translated
+    # builds. Here flat memory shows up as a continuation stack, or chain
+    # of VMFrames, that is as deep after many iterations as after a few.
+    setup = """
+        (def count-up (fn [i n] (if (< i n) (count-up (inc i) n) i)))
+        (def count-down
+          (fn [n] (cond (= n 0) 0 true (let [m (dec n)] (do nil (count-down m))))))
+        (def sum-to (fn [n] (if (< n 1) 0 (+ n (sum-to (dec n))))))"""
+
+    def max_depth(self, monkeypatch, engine, source):
+        depths = [0]
+
+        def record(link, field):
+            depth = 1
+            while link is not None:
+                depth += 1
+                link = getattr(link, field)
+            depths[0] = max(depths[0], depth)
+
+        def push(stack, k):
+            record(stack, "_prev")
+            return interp.Stack(k, stack)
+
+        init = interp.VMFrame.__init__
+
+        def frame_init(frame, code, env, caller):
+            record(caller, "caller")
+            init(frame, code, env, caller)
+
+        monkeypatch.setattr(interp.config, "engine", engine)
+        interp.reset_globals()
+        interp.eval_toplevel(compile_source(self.setup))
+        monkeypatch.setattr(interp.Stack, "push", push)
+        monkeypatch.setattr(interp.VMFrame, "__init__", frame_init)
+        interp.eval_toplevel(compile_source(source))
+        monkeypatch.undo()
+        return depths[0]
+
+    def check_flat(self, monkeypatch, call):
+        for engine in interp.engines:
+            few = self.max_depth(monkeypatch, engine, "(%s 10)" % call)
+            many = self.max_depth(monkeypatch, engine, "(%s 10000)" % call)
+            assert few == many, engine
+
+    def test_if_tail_call_runs_flat(self, monkeypatch):
+        self.check_flat(monkeypatch, "count-up 0")
+
+    def test_cond_let_do_tail_call_runs_flat(self, monkeypatch):
+        self.check_flat(monkeypatch, "count-down")
+
+    def test_non_tail_call_grows(self, monkeypatch):
+        for engine in interp.engines:
+            few = self.max_depth(monkeypatch, engine, "(sum-to 10)")
+            many = self.max_depth(monkeypatch, engine, "(sum-to 100)")
+            assert few < many, engine
+
+
+class TestCommandLine(object):
+    def run_source(self, monkeypatch, tmpdir, source, engine):
+        # entry_point sets the engine for the whole process
+        monkeypatch.setattr(interp.config, "engine", engine)
+        tmpdir.join("loaded.clj").write("(loop [i 0] (+ 1 (recur i)))")
+        main = tmpdir.join("main.clj")
+        main.write(source.replace("LOADED", str(tmpdir.join("loaded.clj"))))
+        return interp.entry_point(["_", "--engine", engine, str(main)])
+
+    def test_recur_arity_error_exits(self, monkeypatch, tmpdir):
+        for engine in interp.engines:
+            assert self.run_source(monkeypatch, tmpdir, "(loop [i 0 j 7] (recur 1))", engine) == 1
+
+    def test_recur_tail_error_exits(self, monkeypatch, tmpdir):
+        for engine in interp.engines:
+            assert self.run_source(monkeypatch, tmpdir, "(loop [i 0] (+ 1 (recur i)))", engine) == 1
+
+    def test_compile_error_in_loaded_file_exits(self, monkeypatch, tmpdir):
+        for engine in interp.engines:
+            assert self.run_source(monkeypatch, tmpdir, '(load-file "LOADED")', engine) == 1
+            assert self.run_source(monkeypatch, tmpdir, "(+ 1 2)", engine) == 0
+
+    def test_bad_jit_params(self):
+        assert interp.entry_point(["_", "--jit", "threshold=x", "f.clj"]) == 1
+        assert interp.entry_point(["_", "--jit", "no_such_param=3", "f.clj"]) == 1
+        assert interp.entry_point(["_", "--jit", "trace_limit=100000", "f.clj"]) == 1
+
+    def test_jit_param_needs_a_value(self):
+        assert interp.entry_point(["_", "f.clj", "--jit"]) == 1
+        assert interp.entry_point(["_", "--jit"]) == 1
+        assert interp.entry_point(["_", "--engine"]) == 1
+
+    def test_unknown_flag(self):
+        assert interp.entry_point(["_", "--jit-stat", "f.clj"]) == 1
@@ -105,3 +105,135 @@
             (= 2 2) (println "Two")))
 
 
+
+(println "TAIL CALLS")
+(def count-up
+  (fn [i n]
+    (if (< i n)
+      (count-up (inc i) n)
+      i)))
+(println "count-up 10000 = " (count-up 0 10000))
+
+(def count-down
+  (fn [n]
+    (cond
+      (= n 0) (quote done)
+      true (let [m (dec n)]
+             (do nil (count-down m))))))
+(println "count-down 10000 = " (count-down 10000))
+
+(println "LOOP")
+(println "sum 0..9 = " (loop [i 0 acc 0]
+                         (if (< i 10)
+                           (recur (inc i) (+ acc i))
+                           acc)))
+(def count-list
+  (fn [n]
+    (loop [i n acc nil]
+      (cond
+        (= i 0) acc
+        true (let [j (dec i)]
+               (recur j (cons i acc)))))))
+(println "(count-list 5) = " (count-list 5))
+(def closures (loop [i 0 acc nil]
+                (if (< i 2)
+                  (recur (inc i) (cons (fn [] i) acc))
+                  acc)))
+(println "closures 1 0 = " ((car closures)) " " ((car (cdr closures))))
+(println "inner recur = " (loop [i 0] (if (< i 3) (loop [j 0] (if (< j 2) (recur (inc j)) (+ i j))) i)))
+(println "(loop [] 7) = " (loop [] 7))
+
+(println "BIGNUMS")
+(def factorial
+  (fn [n]
+    (if (<= n 1)
+      1
+      (* n (factorial (dec n))))))
+(println "(factorial 25) = " (factorial 25))
+(println "max + 1 = " (inc 9223372036854775807))
+(println "min - 1 = " (dec -9223372036854775808))
+(println "back to small = " (- (+ 9223372036854775807 10) 9223372036854775807))
+(println "(/ (factorial 25) (factorial 23)) = " (/ (factorial 25) (factorial 23)))
+(println "compare " (< 9223372036854775807 (inc 9223372036854775807)) " "
+         (= (factorial 22) (* 22 (factorial 21))) " "
+         (> -100000000000000000000 -1))
+
+(println "VARIADIC MATH")
+(println "(+) (+ 5) (+ 1 2 3 4) = " (+) " " (+ 5) " " (+ 1 2 3 4))
+(println "(*) (* 2 3 4) = " (*) " " (* 2 3 4))
+(println "(- 5) (- 10 1 2 3) = " (- 5) " " (- 10 1 2 3))
+(println "(/ 100 5 2) (/ 1) (/ -1) (/ 4) = " (/ 100 5 2) " " (/ 1) " " (/ -1) " " (/ 4))
+(println "apply + '(1 2 3 4 5) = " (apply + '(1 2 3 4 5)))
+(println "overflow midway = " (+ 9223372036854775807 1 -2) " " (* 4294967296 4294967296 2))
+(println "(< 1 2 3) (< 1 3 2) = " (< 1 2 3) " " (< 1 3 2))
+(println "(<= 1 1 2) (>= 3 3 1) (> 3 2 2) = " (<= 1 1 2) " " (>= 3 3 1) " " (> 3 2 2))
+(println "(= 2 2 2) (= 2 2 3) (= 1) = " (= 2 2 2) " " (= 2 2 3) " " (= 1))
+
+(println "VECTORS")
+(def v [1 2 (+ 1 2)])
+(println "v = " v " count " (count v))
+(println "(nth v 0) (nth v 2) = " (nth v 0) " " (nth v 2))
+(println "(vector) (vector 1 2) = " (vector) " " (vector 1 2))
+(println "(conj v 4 5) = " (conj v 4 5) " v = " v)
+(println "quoted '[a [b]] = " '[a [b]])
+(println "(let [w ['x 1]] (count w)) = " (let [w ['x 1]] (count w)))
+(def times10 (fn [x] (* x 10)))
+(println "[(times10 1) 2] [(if true 1 2) 3] = " [(times10 1) 2] " " [(if true 1 2) 3])
+(println "(let [y 5] [y (times10 y)]) = " (let [y 5] [y (times10 y)]))
+(println "list (count '(1 2)) (nth '(1 2 3) 1) (conj '(2) 1) = "
+         (count '(1 2)) " " (nth '(1 2 3) 1) " " (conj '(2) 1))
+
+(println "HASH MAPS")
+(def m (hash-map 'a 1 "b" 2 3 'c))
+(println "get a, b and 3 = " (get m 'a) " " (get m "b") " " (get m 3))
+(println "(get m 'z) (get m 'z 0) (get nil 'a) = " (get m 'z) " " (get m 'z 0) " " (get nil 'a))
+(def m2 (assoc m 'a 10 'd 4))
+(println "(get m2 'a) (get m 'a) (count m) (count m2) = " (get m2 'a) " " (get m 'a) " " (count m) " " (count m2))
+(def m3 (dissoc m2 'a 'missing))
+(println "(get m3 'a) (count m3) (assoc nil 'x 1) = " (get m3 'a) " " (count m3) " " (assoc nil 'x 1))
+(println "big keys " (get (hash-map (factorial 25) 'big) (factorial 25)))
+(def fill
+  (fn [m i n]
+    (if (< i n)
+      (fill (assoc m i (* i i)) (inc i) n)
+      m)))
+(def squares (fill nil 0 2000))
+(def drain
+  (fn [m i n]
+    (if (< i n)
+      (drain (dissoc m i) (+ i 2) n)
+      m)))
+(def odd-squares (drain squares 0 2000))
+(println "2000 squares " (count squares) " " (get squares 1999) " odd " (count odd-squares)
+         " " (get odd-squares 1999) " " (get odd-squares 1998))
+(println "EVAL (let [x 1 y 2 x 3] (+ x y))" (eval nil '(let [x 1 y 2 x 3] (+ x y))))
+
+(println "STRINGS")
+(def s (str "abc" 1 nil 'd))
+(println "(str abc 1 nil 'd) = " s " count " (count s) " " (count ""))
+(println "(subs s 1) (subs s 1 3) = " (subs s 1) " " (subs s 1 3))
+(println "str-concat = " (str-concat "x" "y" "z") " = " (= (str-concat "ab" "c") "abc") " " (= "a" "b"))
+(def repeat-str
+  (fn [acc piece n]
+    (if (< n 1)
+      acc
+      (repeat-str (str-concat acc piece) piece (dec n)))))
+(def long-str (repeat-str "" "0123456789" 10000))
+(println "long string " (count long-str) " " (subs long-str 49995 50005) " "
+         (= long-str (repeat-str "" "01234567890123456789" 5000)))
+(println "string keys " (get (hash-map (str "k" 1) 'found) "k1"))
+
+(println "REDEFINITION")
+(def g 1)
+(def read-g (fn [] g))
+(def before (read-g))
+(def g 2)
+(println "g before and after = " before " " (read-g))
+(println "shadowed builtins = " (let [car cdr] (car '(1 2))) " " ((fn [+] (+ 5 2)) -))
+(def saved-inc inc)
+(def inc dec)
+(println "redefined inc = " (inc 5))
+(def inc saved-inc)
+
+(println "PARSE CACHE")
+(println "(hits misses) = " (parse-cache-stats))